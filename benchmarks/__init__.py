@@ -0,0 +1,4 @@
+"""
+Package: benchmarks
+Benchmarks for the Order service that are run by hand, not by nosetests
+"""
@@ -0,0 +1,103 @@
+"""
+Logging Benchmark
+Times the GET routes with the INFO lines of every lookup written to a log
+file synchronously, through the queue listener and with the per-lookup
+lines sampled, and prints the latency of every mode as JSON
+
+    python -m benchmarks.bench_logging --orders 1000 --requests 2000
+    python -m benchmarks.bench_logging --log-file /var/log/orders.log
+"""
+import os
+import sys
+import json
+import random
+import logging
+import argparse
+import tempfile
+from benchmarks.common import load_app, measure, seed
+
+# name and the LOG_MODE, LOG_FORMAT and LOG_SAMPLING settings of every run
+MODES = (
+    ("sync_text", "sync", "text", ""),
+    ("sync_json", "sync", "json", ""),
+    ("queue_json", "queue", "json", ""),
+    ("queue_json_sampled", "queue", "json", "flask.app.models=0.01,flask.app.reads=0.01"),
+)
+
+
+def parse_args():
+    """ Parses the command line """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=1000, help="number of orders to seed")
+    parser.add_argument("--products", type=int, default=5, help="products per order")
+    parser.add_argument("--requests", type=int, default=2000, help="requests timed per route")
+    parser.add_argument("--log-file", help="file the records are written to (default a temp file)")
+    parser.add_argument("--database-uri", help="database to run against (default $DATABASE_URI)")
+    return parser.parse_args()
+
+
+def configure(app, logs, log_file, mode):
+    """ Points the app logger at log_file and sets it up for mode, returns the listener """
+    _, log_mode, log_format, sampling = mode
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter(
+        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+    ))
+    app.logger.handlers = [handler]
+    app.logger.setLevel(logging.INFO)
+    app.config.update(LOG_MODE=log_mode, LOG_FORMAT=log_format, LOG_SAMPLING=sampling)
+    return logs.init_app(app), handler
+
+
+def main():
+    """ Seeds the database and times the GET routes in every logging mode """
+    args = parse_args()
+    # the cache would skip the lookups and their log lines
+    app, db, Order, Product = load_app( # pylint: disable=invalid-name
+        args.database_uri, CACHE_TYPE="null", METRICS_ENABLED="false"
+    )
+    from service import logs # pylint: disable=import-outside-toplevel
+    db.drop_all()
+    db.create_all()
+    seed(db, Order, Product, args.orders, args.products)
+    db.session.remove()
+
+    log_file = args.log_file or tempfile.mkstemp(suffix=".log")[1]
+    client = app.test_client()
+    routes = [
+        ("get_orders", lambda _: client.get("/orders/{}".format(random.randint(1, args.orders)))),
+        ("list_products", lambda _: client.get(
+            "/orders/{}/products".format(random.randint(1, args.orders)))),
+    ]
+    results = {}
+    for mode in MODES:
+        listener, handler = configure(app, logs, log_file, mode)
+        for name, request in routes:
+            random.seed(name)  # every mode reads the same records
+            results.setdefault(name, {})[mode[0]] = measure(request, args.requests)
+        if listener is not None:
+            listener.stop()
+        handler.close()
+    app.logger.setLevel(logging.CRITICAL)
+
+    for timings in results.values():
+        timings["speedup_p50"] = round(
+            timings["sync_text"]["p50_ms"] / timings["queue_json_sampled"]["p50_ms"], 2
+        )
+
+    json.dump({
+        "meta": {
+            "database": db.engine.url.drivername,
+            "orders": args.orders,
+            "products_per_order": args.products,
+            "requests_per_route": args.requests,
+            "log_file": log_file,
+            "log_bytes": os.path.getsize(log_file),
+        },
+        "results": results,
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Helpers shared by the benchmarks
+"""
+import os
+import time
+import random
+import itertools
+import factory
+import factory.random
+
+# Rows built by the factories that are cycled through when seeding, building
+# every row with Faker would take longer than the benchmark itself
+TEMPLATES = 10000
+
+
+def load_app(database_uri=None, **config):
+    """ Imports the service against database_uri and returns the app and models """
+    if database_uri:
+        os.environ["DATABASE_URI"] = database_uri
+    for name, value in config.items():
+        os.environ[name] = str(value)
+    from service import create_app # pylint: disable=import-outside-toplevel
+    from service.models import db, Order, Product # pylint: disable=import-outside-toplevel
+    app = create_app()
+    app.logger.setLevel("CRITICAL")
+    return app, db, Order, Product
+
+
+def reseed(value):
+    """ Seeds the random numbers of the benchmarks and of the factories
+    so two runs with the same value seed and request the same records
+    """
+    random.seed(value)
+    factory.random.reseed_random(value)
+
+
+def seed(db, Order, Product, orders, products, chunk=10000): # pylint: disable=invalid-name,too-many-arguments
+    """ Inserts orders Orders with products Products each, using executemany in chunks """
+    # the factories import the service, which must wait for load_app() to set DATABASE_URI
+    from tests.factories import OrderFactory, ProductFactory # pylint: disable=import-outside-toplevel
+    order_rows = itertools.cycle(factory.build_batch(
+        dict, min(orders, TEMPLATES), FACTORY_CLASS=OrderFactory
+    ))
+    product_rows = itertools.cycle(factory.build_batch(
+        dict, min(orders * products, TEMPLATES) or 1, FACTORY_CLASS=ProductFactory
+    ))
+    for start in range(1, orders + 1, chunk):
+        ids = range(start, min(start + chunk, orders + 1))
+        db.session.execute(Order.__table__.insert(), [
+            dict(next(order_rows), id=order_id) for order_id in ids
+        ])
+        if products:
+            db.session.execute(Product.__table__.insert(), [
+                dict(next(product_rows), id=None, order_id=order_id)
+                for order_id in ids for _ in range(products)
+            ])
+        db.session.commit()
+    if db.engine.dialect.name == "postgresql":
+        # the ids were given explicitly so move the sequences past them
+        for table in (Order.__table__, Product.__table__):
+            db.session.execute(
+                "SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), "
+                "coalesce(max(id), 0) + 1, false) FROM \"{0}\"".format(table.name)
+            )
+        db.session.commit()
+    # the rows were inserted without the totals that the ORM keeps
+    Order.rebuild_totals(chunk)
+
+
+def percentiles(timings):
+    """ Returns the p50, p90 and p99 of timings in seconds as milliseconds """
+    timings = sorted(timings)
+    def percentile(fraction):
+        return round(timings[min(len(timings) - 1, int(len(timings) * fraction))] * 1000, 3)
+    return {"p50_ms": percentile(0.5), "p90_ms": percentile(0.9), "p99_ms": percentile(0.99)}
+
+
+def measure(func, count):
+    """ Calls func count times and returns its latency percentiles and throughput """
+    timings = []
+    start = time.perf_counter()
+    for n in range(count):
+        call_start = time.perf_counter()
+        func(n)
+        timings.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    result = percentiles(timings)
+    result.update(requests=count, throughput_rps=round(count / elapsed, 1))
+    return result
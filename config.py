@@ -10,5 +10,80 @@ DATABASE_URI = os.getenv("DATABASE_URI", "sqlite:///../development.db")
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool per worker process, turned into SQLALCHEMY_ENGINE_OPTIONS by init_db()
+# Keep workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) below the server's max_connections
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Statement timeout in milliseconds on PostgreSQL, 0 for none
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "0"))
+
+# How Order.products is loaded by the listing endpoints: select, selectin or joined
+LOAD_STRATEGY = os.getenv("LOAD_STRATEGY", "selectin")
+
+# How the GET routes read and encode: orm builds Order and Product instances,
+# core selects plain columns and encodes them with orjson
+READ_PATH = os.getenv("READ_PATH", "orm")
+
+# Page size used when a listing is requested without ?limit= and its upper bound
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Number of rows fetched at a time when a listing is streamed
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "500"))
+
+# Number of orders inserted per transaction by POST /orders:batch
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "1000"))
+
+# Cache of serialized orders and products: lru or null to turn it off
+# Each worker has its own, a cached record is checked against its version
+CACHE_TYPE = os.getenv("CACHE_TYPE", "lru")
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", "60"))
+
+# Request and SQL metrics served at /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Log the requests that run more SQL statements or spend more time in SQL than the budget
+SQL_PROFILING = os.getenv("SQL_PROFILING", "false").lower() == "true"
+SQL_QUERY_BUDGET = int(os.getenv("SQL_QUERY_BUDGET", "10"))
+SQL_TIME_BUDGET_MS = int(os.getenv("SQL_TIME_BUDGET_MS", "100"))
+
+# Logging: sync writes from the request thread, queue hands the records to a
+# listener thread that writes them in batches of LOG_BATCH_SIZE
+LOG_MODE = os.getenv("LOG_MODE", "sync")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+# Fraction of the INFO lines kept per logger, e.g. flask.app.models=0.01,flask.app.reads=0.01
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+
+# Workers that take longer than this from import to create_app() log a warning
+STARTUP_TARGET_MS = int(os.getenv("STARTUP_TARGET_MS", "1000"))
+
+# Compile the hot lookups and open WARM_UP_CONNECTIONS connections in create_app(),
+# which creates the engine at boot instead of on the first request
+WARM_UP = os.getenv("WARM_UP", "false").lower() == "true"
+WARM_UP_CONNECTIONS = int(os.getenv("WARM_UP_CONNECTIONS", str(DB_POOL_SIZE)))
+
+# Responses of the create routes are replayed to retries with the same
+# Idempotency-Key for this many seconds, the recent ones from an in-process LRU
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+
+# POST /orders inserts each order before answering with sync, with queue it
+# journals the order in WRITE_QUEUE_DIR, answers 202 and a worker thread
+# inserts the orders in batches of WRITE_BATCH_SIZE, waiting up to
+# WRITE_BATCH_WAIT_MS for a batch to fill. Orders are refused with 503 once
+# WRITE_QUEUE_MAX_SIZE are waiting
+ORDER_WRITE_MODE = os.getenv("ORDER_WRITE_MODE", "sync")
+WRITE_QUEUE_DIR = os.getenv("WRITE_QUEUE_DIR", "write-queue")
+WRITE_QUEUE_MAX_SIZE = int(os.getenv("WRITE_QUEUE_MAX_SIZE", "10000"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "500"))
+WRITE_BATCH_WAIT_MS = int(os.getenv("WRITE_BATCH_WAIT_MS", "50"))
+WRITE_RETRY_AFTER = int(os.getenv("WRITE_RETRY_AFTER", "1"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
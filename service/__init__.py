@@ -1,10 +1,13 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+This module creates the Flask app and its routes, create_app() sets up the
+logging and SQL database when a worker starts
 """
-import os
+import time
+# The worker boot is timed from the first import of the package
+STARTED = time.perf_counter()
+
 import sys
 import logging
 from flask import Flask
@@ -13,31 +16,58 @@ from flask import Flask
 app = Flask(__name__) # pylint: disable=locally-disabled, invalid-name
 app.config.from_object('config')
 
+# Time every request before the routes are added
+from service.metrics import metrics
+metrics.init_app(app)
+
 # Import the rutes After the Flask app is created
-from service import service, models
+from service import service, models, logs, warmup
+
+
+def create_app():
+    """
+    Sets up the logging and the database of the app and returns it
 
-# Set up logging for production
-if __name__ != '__main__':
-    GUNICORN_LOGGER = logging.getLogger('gunicorn.error')
-    app.logger.handlers = GUNICORN_LOGGER.handlers
-    app.logger.setLevel(GUNICORN_LOGGER.level)
+    This is the entry point of the workers, e.g. gunicorn "service:create_app()".
+    It does not connect to the database, the engine is created by the first
+    request unless WARM_UP is set, nor create the tables, which is done once
+    by flask create-db
+    """
+    if metrics.startup_seconds is not None:
+        return app
+
+    # Set up logging for production
+    gunicorn_logger = logging.getLogger('gunicorn.error')
+    app.logger.handlers = gunicorn_logger.handlers
+    app.logger.setLevel(gunicorn_logger.level)
     app.logger.propagate = False
     # Make all log formats consistent
     formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s",
-                                  "%Y-%m-%d %H:%M:%S %z") # pylint: disable=locally-disabled, invalid-name
+                                  "%Y-%m-%d %H:%M:%S %z")
     for handler in app.logger.handlers:
         handler.setFormatter(formatter)
     app.logger.info('Logging handler established')
 
-app.logger.info(70 * "*")
-app.logger.info("  O R D E R   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
+    # Format, sample and queue the log records as set by LOG_*
+    logs.init_app(app)
+
+    app.logger.info(70 * "*")
+    app.logger.info("  O R D E R   S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
+
+    try:
+        service.init_db()
+    except Exception as error:
+        app.logger.critical("%s: Cannot continue", error)
+        # gunicorn requires exit code 4 to stop spawning workers when they die
+        sys.exit(4)
 
-try:
-    service.init_db()  # make our sqlalchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
+    if app.config["WARM_UP"]:
+        metrics.warm_up_seconds = warmup.warm_up(app)
 
-app.logger.info("Service inititalized!")
+    metrics.startup_seconds = time.perf_counter() - STARTED
+    app.logger.info("Service inititalized in %.0fms!", metrics.startup_seconds * 1000)
+    if metrics.startup_seconds * 1000 > app.config["STARTUP_TARGET_MS"]:
+        app.logger.warning("Startup took %.0fms, over the target of %sms",
+                           metrics.startup_seconds * 1000, app.config["STARTUP_TARGET_MS"])
+    return app
@@ -0,0 +1,690 @@
+"""
+ASGI entry point for the Order service
+Serves the routes of service/service.py from an asyncio event loop with the
+SQLAlchemy asyncio engine, sharing the models, their serialization and the
+cache with the Flask app. Run it with:
+    uvicorn service.asgi:app
+The database is the same DATABASE_URI with the driver switched to asyncpg
+for PostgreSQL and aiosqlite for SQLite.
+
+Idempotency-Key and ORDER_WRITE_MODE work as in the Flask app: the keys are
+in the same table and LRU, and the queued Orders go to the journal and
+worker thread of the write-behind queue, which save them with the Flask engine.
+READ_PATH=core is not: the core reads use the Flask session, so the GET
+routes here always read through the ORM with the asyncio session
+"""
+import logging
+from functools import partial, wraps
+from flask_api import status  # HTTP Status Codes
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import HTTPException as AbortException
+
+from service import app as flask_app, create_app
+from service import idempotency
+from service.cache import cache
+from service.idempotency import store
+from service.models import Order, Product, DataValidationError, Serialized, db
+from service.parsing import (
+    batch_error, check_content_type, check_if_match, get_batch_items, get_order_fields,
+    get_order_filters, get_page_args, is_conditional, is_not_modified
+)
+from service.pool import database_uri, engine_options, pool_status
+from service.service import version_headers
+from service.writebehind import PENDING, QueueFull, write_queue
+
+logger = logging.getLogger("flask.app") # pylint: disable=locally-disabled, invalid-name
+
+# The error names of the Flask error handlers
+ERRORS = {
+    status.HTTP_400_BAD_REQUEST: "Bad Request",
+    status.HTTP_404_NOT_FOUND: "Not Found",
+    status.HTTP_405_METHOD_NOT_ALLOWED: "Method not Allowed",
+    status.HTTP_409_CONFLICT: "Conflict",
+    status.HTTP_412_PRECONDITION_FAILED: "Precondition Failed",
+    status.HTTP_415_UNSUPPORTED_MEDIA_TYPE: "Unsupported media type",
+    status.HTTP_500_INTERNAL_SERVER_ERROR: "Internal Server Error",
+    status.HTTP_503_SERVICE_UNAVAILABLE: "Service Unavailable",
+}
+
+######################################################################
+#  A S Y N C   D A T A B A S E
+######################################################################
+class AsyncDatabase():
+    """ The asyncio engine and session factory of the ASGI app """
+
+    def __init__(self):
+        self.engine = None
+        self.session = None
+
+    async def init_app(self, config):
+        """ Creates the engine for the app configuration, which connects on first use """
+        uri = database_uri(config["SQLALCHEMY_DATABASE_URI"], asyncio=True)
+        logger.info("Initializing asyncio database")
+        self.engine = create_async_engine(uri, **engine_options(config, asyncio=True))
+        # the records are serialized after the commit so it must not expire them
+        self.session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def create_all(self):
+        """ Creates the tables of the models """
+        async with self.engine.begin() as connection:
+            await connection.run_sync(db.Model.metadata.create_all)
+
+    async def drop_all(self):
+        """ Drops the tables of the models """
+        async with self.engine.begin() as connection:
+            await connection.run_sync(db.Model.metadata.drop_all)
+
+    async def dispose(self):
+        """ Closes the connections of the engine """
+        if self.engine is not None:
+            await self.engine.dispose()
+
+
+database = AsyncDatabase() # pylint: disable=locally-disabled, invalid-name
+
+######################################################################
+# Error Handlers
+######################################################################
+def error_response(code, message, headers=None):
+    """ Makes the JSON error response of the Flask error handlers """
+    if code >= status.HTTP_500_INTERNAL_SERVER_ERROR:
+        logger.error(message)
+    else:
+        logger.warning(message)
+    return JSONResponse(
+        {"status": code, "error": ERRORS.get(code, "Error"), "message": message}, code, headers
+    )
+
+async def http_error(request, error): # pylint: disable=unused-argument
+    """ Handles aborted requests and unknown routes and methods """
+    return error_response(error.status_code, str(error.detail))
+
+async def abort_error(request, error): # pylint: disable=unused-argument
+    """ Handles the aborts of the code shared with the Flask app, like the idempotency keys """
+    return error_response(error.code, error.description)
+
+async def queue_full(request, error): # pylint: disable=unused-argument
+    """ Handles a full write-behind queue with 503_SERVICE_UNAVAILABLE """
+    return error_response(
+        status.HTTP_503_SERVICE_UNAVAILABLE, str(error),
+        {"Retry-After": str(flask_app.config["WRITE_RETRY_AFTER"])}
+    )
+
+async def request_validation_error(request, error): # pylint: disable=unused-argument
+    """ Handles Value Errors from bad data """
+    return error_response(status.HTTP_400_BAD_REQUEST, str(error))
+
+async def stale_data_error(request, error):
+    """ Handles a concurrent change to the version being updated
+    It is 412 for a client that sent If-Match, otherwise a 409 it can retry
+    """
+    if "if-match" in request.headers:
+        return error_response(status.HTTP_412_PRECONDITION_FAILED, str(error))
+    return error_response(status.HTTP_409_CONFLICT, str(error))
+
+async def internal_server_error(request, error): # pylint: disable=unused-argument
+    """ Handles unexpected server error with 500_SERVER_ERROR """
+    return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, str(error))
+
+######################################################################
+#  I D E M P O T E N C Y   K E Y S
+######################################################################
+def idempotent(view):
+    """ Makes a create route replay its response to retries with the same Idempotency-Key
+
+    Like the Flask decorator, the key is added to the session of the route,
+    whose write methods only flush, and committed with its response and the
+    record the route creates
+    """
+
+    @wraps(view)
+    async def wrapper(request):
+        client_key = request.headers.get(idempotency.HEADER)
+        if client_key is None:
+            return await view(request)
+        key = idempotency.request_key(request.method, request.url.path, client_key)
+        fingerprint = idempotency.fingerprint_of(await request.body())
+
+        def lookup(session):
+            return store.lookup(key, fingerprint, session)
+
+        async with database.session() as session:
+            stored = await session.run_sync(lookup)
+            if stored is not None:
+                logger.info("Replaying the response to %s", key)
+                return replay(stored)
+            record = store.reserve(key, fingerprint, session.sync_session)
+            request.state.session = session
+            try:
+                response = await view(request)
+                await session.run_sync(lambda session: store.save(
+                    record, response.status_code, response.body, response.headers, session
+                ))
+            except IntegrityError:
+                # a request with the same key committed its record first
+                await session.rollback()
+                stored = await session.run_sync(lookup)
+                if stored is None:
+                    raise
+                return replay(stored)
+            except Exception:
+                await session.rollback()
+                raise
+        return response
+
+    return wrapper
+
+def replay(stored):
+    """ Makes the response of a retry from the StoredResponse """
+    return Response(
+        stored.body, stored.status, dict(stored.headers, **{"Idempotent-Replayed": "true"})
+    )
+
+def request_session(request):
+    """ Returns the session of the Idempotency-Key of the request or a new one
+    Returns:
+        (AsyncSession, bool): the session and whether the caller must close it
+    """
+    session = getattr(request.state, "session", None)
+    if session is not None:
+        return session, False
+    return database.session(), True
+
+######################################################################
+# GET INDEX
+######################################################################
+async def index(request):
+    """ Root URL response """
+    return JSONResponse({
+        "name": "Order REST API Service",
+        "version": "1.0",
+        "paths": request.url_for("list_orders"),
+    })
+
+######################################################################
+# CONNECTION POOL STATUS
+######################################################################
+async def get_pool(request): # pylint: disable=unused-argument
+    """ Returns the size of the database connection pool """
+    return JSONResponse(pool_status(database.engine.sync_engine.pool))
+
+######################################################################
+# LIST ALL Orders
+######################################################################
+async def list_orders(request):
+    """
+    Returns all of the Orders
+    Takes the filters, ?fields= and paging of the Flask route, listings
+    are always paged
+    """
+    logger.info("Request for Order list")
+    fields = get_order_fields(request.query_params)
+    load = flask_app.config["LOAD_STRATEGY"]
+    if fields is not None and "products" not in fields:
+        load = "select"  # the products are never touched so never loaded
+    elif load == "select":
+        load = "selectin"  # there is no lazy loading on the event loop
+    query = select(Order).filter(*Order.search_criteria(**get_order_filters(request.query_params)))
+    query = Order.with_fields(Order.with_loading(query, load), fields)
+    limit, after = get_page_args(request.query_params, flask_app.config)
+    async with database.session() as session:
+        orders, next_cursor = Order.split_page(
+            await fetch_all(session, Order.page_query(query, limit, after)), limit
+        )
+    results = [order.serialize(fields) for order in orders]
+    return page_response(request, results, limit, next_cursor)
+
+######################################################################
+# SUMMARIZE ORDERS
+######################################################################
+async def summarize_orders(request):
+    """
+    Returns the number of Orders and their item_count and total_price by status
+    The Orders can be filtered like the list of Orders
+    """
+    logger.info("Request for Order summary")
+    query = Order.summary_query(**get_order_filters(request.query_params))
+    async with database.session() as session:
+        results = Order.serialize_summary(await session.execute(query))
+    return JSONResponse(results)
+
+######################################################################
+# RETRIEVE AN ORDER
+######################################################################
+async def get_orders(request):
+    """
+    Retrieve a single Order
+    It answers If-None-Match and If-Modified-Since with 304 Not Modified
+    without loading the Order when the client has the current version.
+    Fields without the products are selected alone, the products never loaded
+    """
+    order_id = request.path_params["order_id"]
+    logger.info("Request for Order with id: %s", order_id)
+    fields = get_order_fields(request.query_params)
+    async with database.session() as session:
+        if is_conditional(request.headers):
+            version = await find_version(session, Order, order_id)
+            if version is not None and is_not_modified(request.headers, *version):
+                return not_modified_response(*version)
+        if fields is not None and "products" not in fields:
+            row = (await session.execute(Order.fields_query(order_id, fields))).first()
+            if row is None:
+                raise HTTPException(
+                    status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(order_id)
+                )
+            order = Order.serialize_fields(row, fields)
+            return JSONResponse(order.data, headers=version_headers(order.version, order.updated))
+        order = await find_serialized_or_404(session, Order, order_id)
+        data = order.data
+        if fields is not None:
+            data = {field: data[field] for field in Order.FIELDS if field in fields}
+            if any(field in fields for field in Order.TOTALS):
+                totals = (await session.execute(Order.totals_query(order_id))).first()
+                data.update(
+                    (field, value) for field, value in zip(Order.TOTALS, totals or ())
+                    if field in fields
+                )
+    return JSONResponse(data, headers=version_headers(order.version, order.updated))
+
+######################################################################
+# CREATE A NEW ORDER
+######################################################################
+@idempotent
+async def create_orders(request):
+    """
+    Creates an Order
+    This endpoint will create an Order based the data in the body that is posted
+    A retry with the Idempotency-Key of an earlier request gets its response
+    With ORDER_WRITE_MODE queue the Order is saved later and the response is
+    202 with the Location of its ticket
+    """
+    logger.info("Request to create an Order")
+    check_content_type(request.headers, "application/json")
+    data = await get_json(request)
+    order = Order().deserialize(data)
+    if write_queue.enabled:
+        # the journal is fsynced, which must not block the event loop
+        ticket = await run_in_threadpool(write_queue.submit, data)
+        location_url = request.url_for("get_order_tickets", ticket=ticket)
+        return JSONResponse(
+            {"ticket": ticket, "status": "pending"}, status.HTTP_202_ACCEPTED,
+            {"Location": location_url}
+        )
+    session, owned = request_session(request)
+    try:
+        await session.run_sync(order.create)
+    finally:
+        if owned:
+            await session.close()
+    location_url = request.url_for("get_orders", order_id=order.id)
+    return JSONResponse(
+        order.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+    )
+
+######################################################################
+# GET THE STATUS OF A QUEUED ORDER
+######################################################################
+async def get_order_tickets(request):
+    """
+    Returns the status of an Order accepted by the write-behind queue
+    It is pending with 202 until the Order is saved, then created with the
+    id and Location of the Order or failed with the error, 404 when unknown
+    """
+    ticket = request.path_params["ticket"]
+    logger.info("Request for ticket %s", ticket)
+    async with database.session() as session:
+        record = await session.run_sync(lambda session: write_queue.status(ticket, session))
+    if record is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND, "Ticket '{}' was not found.".format(ticket)
+        )
+    if record is PENDING:
+        location_url = request.url_for("get_order_tickets", ticket=ticket)
+        return JSONResponse(
+            {"ticket": ticket, "status": "pending"}, status.HTTP_202_ACCEPTED,
+            {"Location": location_url}
+        )
+    if record.order_id is None:
+        return JSONResponse({"ticket": ticket, "status": "failed", "error": record.error})
+    location_url = request.url_for("get_orders", order_id=record.order_id)
+    return JSONResponse(
+        {"ticket": ticket, "status": "created", "id": record.order_id},
+        headers={"Location": location_url}
+    )
+
+######################################################################
+# CREATE ORDERS IN BULK
+######################################################################
+async def create_orders_batch(request):
+    """
+    Creates many Orders
+    This endpoint takes a JSON array or newline delimited JSON of Orders and
+    inserts them in chunks of BATCH_CHUNK_SIZE, one transaction per chunk
+    """
+    if request.path_params["action"] != "batch":
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    logger.info("Request to create a batch of Orders")
+    check_content_type(request.headers, "application/json", "application/x-ndjson")
+    results = []
+    orders = []
+    for index, data in enumerate(get_batch_items(request.headers, (await request.body()).decode("utf-8"))):
+        try:
+            orders.append((index, Order().deserialize(data)))
+        except DataValidationError as error:
+            results.append(batch_error(index, status.HTTP_400_BAD_REQUEST, error))
+
+    chunk_size = flask_app.config["BATCH_CHUNK_SIZE"]
+    async with database.session() as session:
+        for start in range(0, len(orders), chunk_size):
+            chunk = orders[start:start + chunk_size]
+            try:
+                await session.run_sync(partial(Order.bulk_create, [order for _, order in chunk]))
+            except SQLAlchemyError as error:
+                logger.error("Could not create batch of Orders: %s", error)
+                results.extend(
+                    batch_error(index, status.HTTP_500_INTERNAL_SERVER_ERROR, error)
+                    for index, _ in chunk
+                )
+                continue
+            results.extend(
+                {
+                    "index": index,
+                    "status": status.HTTP_201_CREATED,
+                    "id": order.id,
+                    "location": request.url_for("get_orders", order_id=order.id),
+                }
+                for index, order in chunk
+            )
+
+    results.sort(key=lambda result: result["index"])
+    created = all(result["status"] == status.HTTP_201_CREATED for result in results)
+    return JSONResponse(
+        results, status.HTTP_201_CREATED if created else status.HTTP_207_MULTI_STATUS
+    )
+
+######################################################################
+# UPDATE AN EXISTING ORDER
+######################################################################
+async def update_orders(request):
+    """
+    Update an Order
+    An If-Match header makes the update fail with 412 Precondition Failed
+    unless the Order is still at that version
+    """
+    order_id = request.path_params["order_id"]
+    logger.info("Request to update order with id: %s", order_id)
+    check_content_type(request.headers, "application/json")
+    data = await get_json(request)
+    async with database.session() as session:
+        order = await find_or_404(session, Order, order_id)
+        check_if_match(request.headers, order.version)
+        order.deserialize(data)
+        order.id = order_id
+        await session.run_sync(order.save)
+    return JSONResponse(order.serialize(), headers=version_headers(order.version, order.updated))
+
+######################################################################
+# DELETE AN ORDER
+######################################################################
+async def delete_orders(request):
+    """
+    Delete an Order
+    This endpoint will delete an Order based the id specified in the path
+    """
+    order_id = request.path_params["order_id"]
+    logger.info("Request to delete order with id: %s", order_id)
+    async with database.session() as session:
+        order = await session.get(Order, order_id)
+        if order:
+            await session.run_sync(order.delete)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+#---------------------------------------------------------------------
+#            	P R O D U C T    M E T H O D S
+#---------------------------------------------------------------------
+######################################################################
+# LIST PRODUCTS
+######################################################################
+async def list_products(request):
+    """
+    Returns all of the Products for an Order
+    The Products are versioned by their Order
+    """
+    order_id = request.path_params["order_id"]
+    logger.info("Request for Order Products...")
+    limit, after = get_page_args(request.query_params, flask_app.config)
+    async with database.session() as session:
+        version = await find_version(session, Order, order_id)
+        if version is None:
+            raise HTTPException(
+                status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(order_id)
+            )
+        if is_not_modified(request.headers, *version):
+            return not_modified_response(*version)
+        query = select(Product).filter(Product.order_id == order_id)
+        products, next_cursor = Product.split_page(
+            await fetch_all(session, Product.page_query(query, limit, after)), limit
+        )
+    results = [product.serialize() for product in products]
+    return page_response(request, results, limit, next_cursor, version_headers(*version))
+
+######################################################################
+# ADD AN PRODUCT TO AN ORDER
+######################################################################
+@idempotent
+async def create_products(request):
+    """
+    Create an Product on an Order
+    This endpoint will add an product to an order
+    A retry with the Idempotency-Key of an earlier request gets its response
+    """
+    order_id = request.path_params["order_id"]
+    logger.info("Request to add an product to an order")
+    check_content_type(request.headers, "application/json")
+    product = Product().deserialize(await get_json(request))
+    session, owned = request_session(request)
+    try:
+        order = await find_or_404(session, Order, order_id)
+        order.products.append(product)
+        await session.run_sync(order.save)
+    finally:
+        if owned:
+            await session.close()
+    return JSONResponse(product.serialize(), status.HTTP_201_CREATED)
+
+######################################################################
+# ADD, UPDATE AND REMOVE PRODUCTS ON AN ORDER IN BULK
+######################################################################
+async def patch_products(request):
+    """
+    Change many Products on an Order
+    This endpoint applies a list of add, update and remove operations to the
+    products of an order in a single transaction and returns the products
+    """
+    order_id = request.path_params["order_id"]
+    logger.info("Request to change products on order with id: %s", order_id)
+    check_content_type(request.headers, "application/json")
+    changes = await get_json(request)
+    async with database.session() as session:
+        order = await find_or_404(session, Order, order_id)
+        await session.run_sync(partial(order.apply_product_changes, changes))
+    return JSONResponse([product.serialize() for product in order.products])
+
+######################################################################
+# RETRIEVE AN Product FROM ORDER
+######################################################################
+async def get_products(request):
+    """
+    Get an Product
+    This endpoint returns just an product
+    """
+    product_id = request.path_params["product_id"]
+    logger.info("Request to get an product with id: %s", product_id)
+    async with database.session() as session:
+        if is_conditional(request.headers):
+            version = await find_version(session, Product, product_id)
+            if version is not None and is_not_modified(request.headers, *version):
+                return not_modified_response(*version)
+        product = await find_serialized_or_404(session, Product, product_id)
+    return JSONResponse(product.data, headers=version_headers(product.version, product.updated))
+
+######################################################################
+# UPDATE AN Product
+######################################################################
+async def update_products(request):
+    """
+    Update an Product
+    An If-Match header makes the update fail with 412 Precondition Failed
+    unless the Product is still at that version
+    """
+    product_id = request.path_params["product_id"]
+    logger.info("Request to update product with id: %s", product_id)
+    check_content_type(request.headers, "application/json")
+    data = await get_json(request)
+    async with database.session() as session:
+        product = await find_or_404(session, Product, product_id)
+        check_if_match(request.headers, product.version)
+        product.deserialize(data)
+        product.id = product_id
+        await session.run_sync(product.save)
+    return JSONResponse(
+        product.serialize(), headers=version_headers(product.version, product.updated)
+    )
+
+######################################################################
+# DELETE AN PRODUCT
+######################################################################
+async def delete_products(request):
+    """
+    Delete an Product
+    This endpoint will delete an Product based the id specified in the path
+    """
+    product_id = request.path_params["product_id"]
+    logger.info("Request to delete product with id: %s", product_id)
+    async with database.session() as session:
+        product = await session.get(Product, product_id)
+        if product:
+            await session.run_sync(product.delete)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+async def fetch_all(session, query):
+    """ Returns the records of a select() of a model """
+    result = await session.execute(query)
+    # joined loading of a collection repeats the rows of each record
+    return result.unique().scalars().all()
+
+async def find_or_404(session, model, by_id):
+    """ Finds a record by it's id with the relationships it serializes """
+    logger.info("Processing lookup or 404 for id %s ...", by_id)
+    records = await fetch_all(session, model.with_loading(select(model).filter(model.id == by_id)))
+    if not records:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            "{} with id '{}' was not found.".format(model.__name__, by_id)
+        )
+    return records[0]
+
+async def find_version(session, model, by_id):
+    """ Returns the version and update time of a record from the database without loading it """
+    logger.info("Processing version lookup for id %s ...", by_id)
+    result = await session.execute(
+        select(model.version, model.updated).filter(model.id == by_id)
+    )
+    return result.first()
+
+async def find_serialized_or_404(session, model, by_id):
+    """ Returns a Serialized record from the cache while it is at the version
+    in the database, loading it otherwise
+    """
+    key = model.cache_key(by_id)
+    serialized = cache.get(key)
+    if serialized is not None:
+        version = await find_version(session, model, by_id)
+        if version is not None and version[0] == serialized.version:
+            return serialized
+        cache.delete(key)  # changed or deleted through another worker
+    record = await find_or_404(session, model, by_id)
+    serialized = Serialized(record.serialize(), record.version, record.updated)
+    cache.set(key, serialized)
+    return serialized
+
+async def get_json(request):
+    """ Returns the JSON body of a request """
+    try:
+        return await request.json()
+    except ValueError:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Request body must be JSON")
+
+def page_response(request, results, limit, next_cursor, headers=None):
+    """ Makes a listing response with a Link to the next page if there is one """
+    headers = dict(headers or {})
+    if next_cursor is not None:
+        next_url = request.url.include_query_params(limit=limit, after=next_cursor)
+        headers["Link"] = '<{}>; rel="next"'.format(next_url)
+        headers["X-Next-Cursor"] = str(next_cursor)
+    return JSONResponse(results, headers=headers)
+
+def not_modified_response(version, updated):
+    """ Makes a 304 Not Modified response for a version of a resource """
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED, headers=version_headers(version, updated)
+    )
+
+######################################################################
+#  A S G I   A P P L I C A T I O N
+######################################################################
+async def startup():
+    """ Sets up the app and its asyncio engine when the server starts
+    create_app() also starts the write-behind queue that create_orders uses
+    """
+    create_app()
+    if flask_app.config["READ_PATH"] == "core":
+        logger.warning("READ_PATH=core is not used by the ASGI app, it reads through the ORM")
+    await database.init_app(flask_app.config)
+
+app = Starlette( # pylint: disable=locally-disabled, invalid-name
+    routes=[
+        Route("/", index),
+        Route("/pool", get_pool, methods=["GET"]),
+        Route("/orders", list_orders, methods=["GET"]),
+        Route("/orders", create_orders, methods=["POST"]),
+        # the router drops a literal :suffix from paths so it is taken as a parameter
+        Route("/orders:{action}", create_orders_batch, methods=["POST"]),
+        Route("/orders/summary", summarize_orders, methods=["GET"]),
+        Route("/orders/tickets/{ticket}", get_order_tickets, methods=["GET"]),
+        Route("/orders/{order_id:int}", get_orders, methods=["GET"]),
+        Route("/orders/{order_id:int}", update_orders, methods=["PUT"]),
+        Route("/orders/{order_id:int}", delete_orders, methods=["DELETE"]),
+        Route("/orders/{order_id:int}/products", list_products, methods=["GET"]),
+        Route("/orders/{order_id:int}/products", create_products, methods=["POST"]),
+        Route("/orders/{order_id:int}/products", patch_products, methods=["PATCH"]),
+        Route("/orders/{order_id:int}/products/{product_id:int}", get_products, methods=["GET"]),
+        Route("/orders/{order_id:int}/products/{product_id:int}", update_products, methods=["PUT"]),
+        Route(
+            "/orders/{order_id:int}/products/{product_id:int}", delete_products, methods=["DELETE"]
+        ),
+    ],
+    exception_handlers={
+        HTTPException: http_error,
+        AbortException: abort_error,
+        QueueFull: queue_full,
+        DataValidationError: request_validation_error,
+        StaleDataError: stale_data_error,
+        status.HTTP_500_INTERNAL_SERVER_ERROR: internal_server_error,
+    },
+    on_startup=[startup],
+    on_shutdown=[database.dispose],
+)
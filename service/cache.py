@@ -0,0 +1,153 @@
+"""
+Cache for Order and Product reads
+The serialized records are cached by key and evicted by PersistentBase
+whenever a commit changes them. A worker only evicts its own cache, so a
+cached record is returned only after its version is read from the database
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app") # pylint: disable=locally-disabled, invalid-name
+
+
+######################################################################
+#  C A C H E   B A C K E N D S
+######################################################################
+class CacheBackend():
+    """
+    Interface of a cache backend
+    A backend for a shared cache like Redis implements the same methods
+    """
+
+    def get(self, key):
+        """ Returns the value stored under key or None """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ Stores value under key """
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        """ Removes the keys from the cache """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes everything from the cache """
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    """ Backend that never stores anything, used when caching is turned off """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    """
+    In-process cache that holds at most max_size values for ttl seconds,
+    evicting the least recently used value when it is full
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._values[key]
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = (time.monotonic() + self.ttl, value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+######################################################################
+#  C A C H E
+######################################################################
+class Cache():
+    """
+    Cache that is configured from the Flask app like the SQLAlchemy object
+    Values are shared with every caller so they must not be modified
+    """
+
+    def __init__(self):
+        self.backend = NullCache()
+
+    def init_app(self, app, backend=None):
+        """
+        Creates the backend named by CACHE_TYPE
+        Args:
+            app (Flask): the app with the CACHE_* configuration
+            backend (CacheBackend): a backend to use instead of CACHE_TYPE
+        """
+        if backend is not None:
+            self.backend = backend
+            return
+        cache_type = app.config.get("CACHE_TYPE", "lru")
+        logger.info("Initializing %s cache", cache_type)
+        if cache_type == "lru":
+            self.backend = LRUCache(
+                app.config.get("CACHE_MAX_SIZE", 10000), app.config.get("CACHE_TTL", 60)
+            )
+        elif cache_type == "null":
+            self.backend = NullCache()
+        else:
+            raise ValueError("Unknown cache type: {}".format(cache_type))
+
+    def get(self, key):
+        """ Returns the value stored under key or None """
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        """ Stores value under key """
+        self.backend.set(key, value)
+
+    def delete(self, *keys):
+        """ Removes the keys from the cache """
+        if keys:
+            self.backend.delete(*keys)
+
+    def clear(self):
+        """ Removes everything from the cache """
+        self.backend.clear()
+
+
+# The cache used by the models, initialized in PersistentBase.init_db()
+cache = Cache() # pylint: disable=locally-disabled, invalid-name
@@ -0,0 +1,145 @@
+"""
+Idempotency keys for the create routes
+A client that sends an Idempotency-Key header with a POST can retry it as
+often as it needs to: the first request creates the record and stores its
+response in the same commit, the retries get that response back without
+deserializing or inserting anything. The responses are kept in the idempotency_key table for
+IDEMPOTENCY_TTL seconds with an in-process LRU of the recent ones in front
+"""
+import hashlib
+import logging
+from functools import wraps
+from collections import namedtuple
+from flask import request, abort, make_response
+from flask_api import status  # HTTP Status Codes
+from sqlalchemy.exc import IntegrityError
+from service.cache import LRUCache, NullCache
+from service.models import DEFER_COMMIT, IdempotencyKey, commit_session, db
+
+logger = logging.getLogger("flask.app") # pylint: disable=locally-disabled, invalid-name
+
+HEADER = "Idempotency-Key"
+# leaves room for the method and path in IdempotencyKey.key
+MAX_KEY_LENGTH = 200
+# the headers of a response that are replayed with its body
+STORED_HEADERS = ("Content-Type", "Location")
+
+# A stored response, shared by every replay so it must not be modified
+StoredResponse = namedtuple("StoredResponse", ("fingerprint", "status", "body", "headers"))
+
+
+class IdempotencyStore():
+    """ The stored responses, configured from the Flask app like the cache """
+
+    def __init__(self):
+        self.ttl = 86400
+        self.responses = NullCache()
+
+    def init_app(self, app):
+        """ Creates the LRU of the recent responses """
+        self.ttl = app.config.get("IDEMPOTENCY_TTL", 86400)
+        self.responses = LRUCache(app.config.get("IDEMPOTENCY_CACHE_SIZE", 10000), self.ttl)
+
+    def lookup(self, key, fingerprint, session=None):
+        """ Returns the StoredResponse of a key or None when it was never used
+
+        Aborts with 400 when the key was used with another body
+        """
+        stored = self.responses.get(key)
+        if stored is None:
+            record = IdempotencyKey.find(key, self.ttl, session)
+            if record is None:
+                return None
+            stored = StoredResponse(record.fingerprint, record.status, record.body, record.headers)
+            self.responses.set(key, stored)
+        if stored.fingerprint != fingerprint:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  "Idempotency-Key {} was used with a different request body".format(key))
+        return stored
+
+    @staticmethod
+    def reserve(key, fingerprint, session=None):
+        """ Adds the key to the session and has its write methods only flush
+        until save() commits the key with the record the request creates
+        """
+        session = session or db.session
+        record = IdempotencyKey(key=key, fingerprint=fingerprint)
+        session.add(record)
+        session.info[DEFER_COMMIT] = True
+        return record
+
+    def save(self, record, code, body, headers, session=None):
+        """ Stores the response of the request that reserved the key
+        It is committed in one transaction with the record the request created
+        """
+        record.status = code
+        record.body = body
+        record.headers = {name: headers[name] for name in STORED_HEADERS if name in headers}
+        commit_session(session)
+        self.responses.set(record.key, StoredResponse(
+            record.fingerprint, record.status, record.body, record.headers
+        ))
+
+
+store = IdempotencyStore() # pylint: disable=locally-disabled, invalid-name
+
+
+def request_key(method, path, client_key):
+    """ Returns the key of a request, aborting with 400 when the client key is not valid """
+    if not client_key or len(client_key) > MAX_KEY_LENGTH:
+        abort(status.HTTP_400_BAD_REQUEST,
+              "{} must have 1 to {} characters".format(HEADER, MAX_KEY_LENGTH))
+    return "{} {} {}".format(method, path, client_key)
+
+
+def fingerprint_of(body):
+    """ Returns the fingerprint of a request body """
+    return hashlib.sha256(body).hexdigest()
+
+
+def release(session):
+    """ Lets the write methods of the session commit again after a request """
+    session.info.pop(DEFER_COMMIT, None)
+    session.info.pop("evict", None)
+
+
+def replay(stored):
+    """ Makes the response of a retry from the StoredResponse """
+    response = make_response(stored.body, stored.status, stored.headers)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def idempotent(view):
+    """ Makes a create route replay its response to retries with the same Idempotency-Key """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(HEADER)
+        if client_key is None:
+            return view(*args, **kwargs)
+        key = request_key(request.method, request.path, client_key)
+        fingerprint = fingerprint_of(request.get_data())
+        stored = store.lookup(key, fingerprint)
+        if stored is not None:
+            logger.info("Replaying the response to %s", key)
+            return replay(stored)
+        record = store.reserve(key, fingerprint)
+        try:
+            response = make_response(view(*args, **kwargs))
+            store.save(record, response.status_code, response.get_data(), response.headers)
+        except IntegrityError:
+            # a request with the same key committed its record first
+            db.session.rollback()
+            stored = store.lookup(key, fingerprint)
+            if stored is None:
+                raise
+            return replay(stored)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            release(db.session)
+        return response
+
+    return wrapper
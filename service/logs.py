@@ -0,0 +1,214 @@
+"""
+Logging off the request thread
+With LOG_MODE set to queue the app logger only puts its records on a
+bounded queue and a listener thread formats them and writes them to the
+real handlers in batches, so a request never waits on a log stream.
+
+LOG_FORMAT json writes every record as one JSON object per line and
+LOG_SAMPLING keeps only a fraction of the INFO records of the loggers it
+names, e.g. flask.app.models=0.01 keeps one in a hundred of the per-lookup
+lines of the models
+"""
+import sys
+import json
+import queue
+import atexit
+import logging
+import itertools
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler
+
+# Attributes of every LogRecord, anything else was passed with extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message"}
+
+
+######################################################################
+#  F O R M A T T E R S   A N D   F I L T E R S
+######################################################################
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one line of JSON """
+
+    def format(self, record):
+        """ Returns the record and its extra attributes as a JSON object """
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES and not name.startswith("_"):
+                data[name] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """ Keeps one in every 1 / rate INFO and DEBUG records of the sampled loggers
+
+    Records at WARNING and above and those of other loggers always pass
+    """
+
+    def __init__(self, rates):
+        """
+        Args:
+            rates (dict): the fraction of the records kept by logger name,
+                the name of a logger also covers its children
+        """
+        super().__init__()
+        self.rates = dict(rates)
+        self.counters = {
+            name: (max(round(1 / rate), 1) if rate > 0 else 0, itertools.count())
+            for name, rate in self.rates.items()
+        }
+
+    def sampled_logger(self, name):
+        """ Returns the most specific sampled logger that covers name or None """
+        while name:
+            if name in self.counters:
+                return name
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record):
+        """ Returns whether the record is kept """
+        if record.levelno > logging.INFO:
+            return True
+        name = self.sampled_logger(record.name)
+        if name is None:
+            return True
+        every, counter = self.counters[name]
+        return every > 0 and next(counter) % every == 0
+
+
+def parse_sampling(value):
+    """ Parses LOG_SAMPLING as comma separated logger=rate pairs
+
+    Raises:
+        ValueError: when a pair has no rate or the rate is not in [0, 1]
+    """
+    rates = {}
+    for pair in filter(None, (part.strip() for part in (value or "").split(","))):
+        name, _, rate = pair.partition("=")
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError("Sampling rate of {} must be between 0 and 1".format(name))
+        rates[name.strip()] = rate
+    return rates
+
+
+######################################################################
+#  Q U E U E   H A N D L E R   A N D   L I S T E N E R
+######################################################################
+class AsyncQueueHandler(QueueHandler):
+    """ Puts records on a bounded queue and drops them when it is full """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """ Merges the arguments into the message and leaves the formatting to the listener """
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        """ Never blocks the request, counting the records that did not fit """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingListener():
+    """ Thread that writes the queued records to the handlers in batches """
+
+    STOP = None
+
+    def __init__(self, log_queue, handlers, batch_size=100):
+        self.queue = log_queue
+        self.handlers = list(handlers)
+        self.batch_size = batch_size
+        self.thread = None
+
+    def start(self):
+        """ Starts the listener thread """
+        self.thread = threading.Thread(target=self.run, name="log-listener", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Writes the records still queued and stops the thread """
+        if self.thread is None:
+            return
+        self.queue.put(self.STOP)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        """ Waits for a record and writes it with the others already queued """
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not self.STOP and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is self.STOP
+            self.write([record for record in batch if record is not self.STOP])
+            if stopping:
+                return
+
+    def write(self, records):
+        """ Writes the records to every handler, with one write per stream """
+        for handler in self.handlers:
+            accepted = [record for record in records
+                        if record.levelno >= handler.level and handler.filter(record)]
+            if not accepted:
+                continue
+            if not isinstance(handler, logging.StreamHandler) or handler.stream is None:
+                for record in accepted:
+                    handler.handle(record)
+                continue
+            try:
+                text = "".join(handler.format(record) + handler.terminator for record in accepted)
+                with handler.lock:
+                    handler.stream.write(text)
+                    handler.flush()
+            except Exception: # pylint: disable=broad-except
+                handler.handleError(accepted[0])
+
+
+######################################################################
+#  S E T U P
+######################################################################
+def init_app(app):
+    """ Sets up the format, sampling and mode of the app logger from the LOG_* settings
+
+    Returns:
+        the BatchingListener in queue mode, otherwise None
+    """
+    config = app.config
+    handlers = app.logger.handlers or [logging.StreamHandler(sys.stderr)]
+    if config["LOG_FORMAT"] == "json":
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+    sampling = parse_sampling(config["LOG_SAMPLING"])
+    listener = None
+    if config["LOG_MODE"] == "queue":
+        listener = BatchingListener(
+            queue.Queue(config["LOG_QUEUE_SIZE"]), handlers, config["LOG_BATCH_SIZE"]
+        )
+        handlers = [AsyncQueueHandler(listener.queue)]
+        listener.start()
+        atexit.register(listener.stop)
+    if sampling:
+        # on the handler so the records propagated from child loggers are sampled too
+        for handler in handlers:
+            handler.addFilter(SamplingFilter(sampling))
+    if config["LOG_MODE"] == "queue" or app.logger.handlers:
+        app.logger.handlers = handlers
+    return listener
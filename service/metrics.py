@@ -0,0 +1,263 @@
+"""
+Request metrics in the Prometheus text format
+Counts and times every request, the SQL statements it runs and the size
+of the payload it sends back, for GET /metrics to expose
+
+With SQL_PROFILING turned on the statements of every request are kept and
+the requests that go over SQL_QUERY_BUDGET or SQL_TIME_BUDGET_MS are
+logged together with their statements
+"""
+import time
+import bisect
+import logging
+import threading
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+logger = logging.getLogger("flask.app") # pylint: disable=locally-disabled, invalid-name
+
+
+def format_labels(names, values):
+    """ Formats label names and values as {name="value",...} """
+    if not names:
+        return ""
+    pairs = ('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+             for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+######################################################################
+#  M E T R I C   T Y P E S
+######################################################################
+class Counter():
+    """ A count that only goes up, one per combination of label values """
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """ Adds amount to the count of the label values """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        """ Returns the counter in the Prometheus text format """
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} counter".format(self.name),
+        ]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append("{}{} {}".format(
+                    self.name, format_labels(self.labels, label_values), value
+                ))
+        return lines
+
+
+class Histogram():
+    """ Observations counted in buckets, one set per combination of label values """
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """ Records one observation of value for the label values """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # one count per bucket plus +Inf, the sum and the total count
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        """ Returns the histogram in the Prometheus text format """
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        names = self.labels + ("le",)
+        with self._lock:
+            for label_values, counts in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(
+                        self.name, format_labels(names, label_values + (bound,)), cumulative
+                    ))
+                labels = format_labels(self.labels, label_values)
+                lines.append("{}_sum{} {}".format(self.name, labels, counts[-2]))
+                lines.append("{}_count{} {}".format(self.name, labels, counts[-1]))
+        return lines
+
+
+######################################################################
+#  R E Q U E S T   M E T R I C S
+######################################################################
+class RequestTimer():
+    """ The time and SQL statements of the request a thread is handling """
+    __slots__ = ("start", "sql_count", "sql_seconds", "statements")
+
+    def __init__(self, profiling=False):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        # (seconds, statement) of every statement when profiling
+        self.statements = [] if profiling else None
+
+
+# The RequestTimer of each thread, a plain thread local is much cheaper
+# than flask.g to reach from the SQL statement hooks
+_current = threading.local() # pylint: disable=locally-disabled, invalid-name
+
+
+def current_timer():
+    """ Returns the RequestTimer of the request this thread is handling or None """
+    return getattr(_current, "timer", None)
+
+
+class Metrics():
+    """ The metrics of the service, hooked into the Flask app by init_app() """
+
+    def __init__(self):
+        self.requests = Counter(
+            "http_requests_total", "Requests handled", ("method", "endpoint", "status")
+        )
+        self.latency = Histogram(
+            "http_request_duration_seconds", "Time to handle a request",
+            ("method", "endpoint")
+        )
+        self.queries = Histogram(
+            "db_queries_per_request", "SQL statements run by a request",
+            ("endpoint",), QUERY_BUCKETS
+        )
+        self.query_time = Histogram(
+            "db_query_duration_seconds_per_request", "Time spent in SQL by a request",
+            ("endpoint",)
+        )
+        self.payload_size = Histogram(
+            "http_response_size_bytes", "Size of the serialized response body",
+            ("endpoint",), SIZE_BUCKETS
+        )
+
+        # set by create_app() once the worker has booted
+        self.startup_seconds = None
+        self.warm_up_seconds = None
+        # latency of the first request of the worker to compare with the steady state
+        self.first_request_seconds = None
+        self.enabled = False
+        self.profiling = False
+        self.query_budget = 0
+        self.time_budget = 0.0
+
+    def init_app(self, app):
+        """ Times every request of app and the SQL statements it runs """
+        self.enabled = app.config.get("METRICS_ENABLED", True)
+        self.profiling = app.config.get("SQL_PROFILING", False)
+        self.query_budget = app.config.get("SQL_QUERY_BUDGET", 10)
+        self.time_budget = app.config.get("SQL_TIME_BUDGET_MS", 100) / 1000.0
+        if not (self.enabled or self.profiling):
+            return
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(Engine, "handle_error", handle_error)
+
+    def before_request(self):
+        """ Starts timing a request """
+        _current.timer = RequestTimer(self.profiling)
+
+    def after_request(self, response):
+        """ Records the metrics of a finished request """
+        timer = current_timer()
+        if timer is None:
+            return response
+        _current.timer = None
+        endpoint = request.url_rule.endpoint if request.url_rule else "unmatched"
+        if timer.statements is not None:
+            self.check_budget(timer, endpoint)
+        if not self.enabled:
+            return response
+        latency = time.perf_counter() - timer.start
+        if self.first_request_seconds is None:
+            self.first_request_seconds = latency
+        self.requests.inc(request.method, endpoint, response.status_code)
+        self.latency.observe(latency, request.method, endpoint)
+        self.queries.observe(timer.sql_count, endpoint)
+        self.query_time.observe(timer.sql_seconds, endpoint)
+        if response.content_length is not None:
+            self.payload_size.observe(response.content_length, endpoint)
+        return response
+
+    def check_budget(self, timer, endpoint):
+        """ Logs a request that ran too many or too slow SQL statements """
+        if timer.sql_count <= self.query_budget and timer.sql_seconds <= self.time_budget:
+            return
+        lines = [
+            "  {:8.3f}ms {}".format(seconds * 1000, " ".join(statement.split()))
+            for seconds, statement in timer.statements
+        ]
+        logger.warning(
+            "%s %s (%s) ran %s SQL statements in %.3fms, over the budget of %s in %.0fms:\n%s",
+            request.method, request.path, endpoint, timer.sql_count, timer.sql_seconds * 1000,
+            self.query_budget, self.time_budget * 1000, "\n".join(lines)
+        )
+
+    def render(self, gauges=None):
+        """
+        Returns all of the metrics in the Prometheus text format
+        Args:
+            gauges (dict): extra values sampled at scrape time by metric name
+        """
+        lines = []
+        for metric in (self.requests, self.latency, self.queries,
+                       self.query_time, self.payload_size):
+            lines.extend(metric.render())
+        for name, value in sorted((gauges or {}).items()):
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany): # pylint: disable=unused-argument,too-many-arguments
+    """ Starts timing a SQL statement, by its cursor as it may fail before it finishes """
+    conn.info.setdefault("query_start", {})[id(cursor)] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany): # pylint: disable=unused-argument,too-many-arguments
+    """ Adds a finished SQL statement to the metrics of the current request """
+    elapsed = time.perf_counter() - conn.info["query_start"].pop(id(cursor))
+    timer = current_timer()
+    if timer is not None:
+        timer.sql_count += 1
+        timer.sql_seconds += elapsed
+        if timer.statements is not None:
+            timer.statements.append((elapsed, statement))
+
+
+def handle_error(exception_context):
+    """ Drops the start of a failed SQL statement so it is not kept by its connection """
+    connection = exception_context.connection
+    if connection is not None and exception_context.cursor is not None:
+        connection.info.get("query_start", {}).pop(id(exception_context.cursor), None)
+
+
+# The metrics of the service, hooked into the app in service/__init__.py
+metrics = Metrics() # pylint: disable=locally-disabled, invalid-name
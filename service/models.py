@@ -3,60 +3,283 @@ Models for Order
 All of the models are stored in this module
 """
 import logging
+from collections import namedtuple
+from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, inspect, select, text
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import Session, attributes, joinedload, lazyload, load_only, selectinload
+from sqlalchemy.orm.util import identity_key
+from service.cache import cache
+from service.pool import database_uri, engine_options
 
-logger = logging.getLogger("flask.app") # pylint: disable=locally-disabled, invalid-name
+logger = logging.getLogger("flask.app.models") # pylint: disable=locally-disabled, invalid-name
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy() # pylint: disable=locally-disabled, invalid-name
+# The records keep the values they were written with after a commit so that
+# the write routes can serialize them without reading them back, the session
+# is expired at the start of every request instead by expire_session()
+db = SQLAlchemy(session_options={"expire_on_commit": False}) # pylint: disable=locally-disabled, invalid-name
+
+def expire_session():
+    """
+    Expires every record in the session so this request reads them again
+    The app context that init_db() pushes keeps the session open across
+    requests and the session does not expire the records on commit
+    """
+    db.session.expire_all()
+
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
-    pass
+
+
+# Set in the info of a session whose changes must be committed together with
+# something the caller adds afterwards, the write methods only flush them
+DEFER_COMMIT = "defer_commit"
+
+
+def commit_session(session=None):
+    """ Commits the session and evicts the records its write methods changed """
+    session = session or db.session
+    keys = session.info.pop("evict", set())
+    session.commit()
+    cache.delete(*keys)
+
+
+def to_integer(value, name):
+    """ Returns value as an int, accepting integral numbers and numeric strings
+    Raises:
+        DataValidationError: when value is not a whole number
+    """
+    if isinstance(value, bool):
+        raise DataValidationError("Invalid Item: {} must be an integer".format(name))
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (int, str)):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    raise DataValidationError("Invalid Item: {} must be an integer".format(name))
 
 # DATETIME_FORMAT='%Y-%m-%d %H:%M:%S.%f'
 
+# Relationship loading strategies that can be chosen per query:
+#   select   - lazy load each relationship on first access (one query per record)
+#   selectin - load the relationship for all records with one extra IN query
+#   joined   - load the relationship in the same query with a LEFT OUTER JOIN
+LOAD_STRATEGIES = {
+    "select": lazyload,
+    "selectin": selectinload,
+    "joined": joinedload,
+}
+DEFAULT_LOAD_STRATEGY = "selectin"
+
+# A serialized record with the version and time of its last change
+Serialized = namedtuple("Serialized", "data version updated")
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
 class PersistentBase():
     """ Base class added persistent methods """
 
-    def create(self):
+    # Relationships that serialize() walks and that should be loaded
+    # together with the records when listing
+    eager_relationships = ()
+
+    # The write methods take the session to use so that the ASGI app can run
+    # them on the session of its asyncio engine, db.session is used otherwise
+
+    def create(self, session=None):
         """
         Creates a Order to the database
         """
         logger.info("Creating %s", self.name)
         self.id = None  # id must be none to generate next primary key
-        db.session.add(self)
-        db.session.commit()
+        for relationship in self.eager_relationships:
+            if relationship not in self.__dict__:
+                # a new record has none yet, so serializing it never loads them
+                setattr(self, relationship, [])
+        session = session or db.session
+        session.add(self)
+        self._commit(session)
 
-    def save(self):
+    def save(self, session=None):
         """ Updates a Order to the database """
         logger.info("Saving %s", self.name)
-        db.session.commit()
+        self._commit(session)
 
-    def delete(self):
+    def delete(self, session=None):
         """ Removes a Order from the data store """
         logger.info("Deleting %s", self.name)
-        db.session.delete(self)
-        db.session.commit()
+        session = session or db.session
+        session.delete(self)
+        self._commit(session)
+
+    @staticmethod
+    def _commit(session=None):
+        """ Commits the session and evicts every record it changed from the cache
+        With DEFER_COMMIT set the changes are only flushed and the caller
+        commits them with commit_session()
+        """
+        session = session or db.session
+        keys = session.info.setdefault("evict", set())
+        for record in session.new | session.dirty | session.deleted:
+            if isinstance(record, PersistentBase):
+                keys.update(record.cache_keys())
+        if session.info.get(DEFER_COMMIT):
+            session.flush()
+            return
+        commit_session(session)
+
+    @classmethod
+    def cache_key(cls, by_id):
+        """ Returns the key a record is cached under """
+        return "{}:{}".format(cls.__tablename__, by_id)
+
+    def cache_keys(self):
+        """ Returns the keys of the cached records that include this record """
+        if self.id is None:
+            return []
+        return [self.cache_key(self.id)]
 
     @classmethod
     def init_db(cls, app):
-        """ Initializes the database session """
+        """
+        Initializes the database session
+        The engine is only created when the first query needs it and the
+        tables are created by flask create-db, so this never connects
+        """
         logger.info("Initializing database")
         cls.app = app
+        # SQLAlchemy 1.4 no longer accepts the postgres:// scheme
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_uri(app.config["SQLALCHEMY_DATABASE_URI"])
+        app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config))
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
+        cache.init_app(app)
+        if expire_session not in app.before_request_funcs.get(None, []):
+            app.before_request(expire_session)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
 
     @classmethod
-    def all(cls):
+    def with_loading(cls, query, load=DEFAULT_LOAD_STRATEGY):
+        """ Applies a relationship loading strategy to a query
+        Args:
+            query (Query): the query to apply the strategy to
+            load (string): one of the names in LOAD_STRATEGIES
+        """
+        try:
+            loader = LOAD_STRATEGIES[load]
+        except KeyError:
+            raise ValueError("Unknown load strategy: {}".format(load))
+        for relationship in cls.eager_relationships:
+            query = query.options(loader(getattr(cls, relationship)))
+        return query
+
+    @classmethod
+    def add_missing_columns(cls):
+        """
+        Adds the columns of the table that are missing from the database
+        db.create_all() never alters existing tables so this is the migration
+        path for databases created before a column was added
+        """
+        existing = {
+            column["name"] for column in inspect(db.engine).get_columns(cls.__tablename__)
+        }
+        table = db.engine.dialect.identifier_preparer.format_table(cls.__table__)
+        added = []
+        for column in cls.__table__.columns:
+            if column.name not in existing:
+                logger.info("Adding column %s.%s", cls.__tablename__, column.name)
+                definition = CreateColumn(column).compile(dialect=db.engine.dialect)
+                db.engine.execute("ALTER TABLE {} ADD COLUMN {}".format(table, definition))
+                added.append(column.name)
+        return added
+
+    @classmethod
+    def create_indexes(cls):
+        """
+        Creates the indexes of the table that are missing from the database
+        db.create_all() only creates indexes with new tables so this is the
+        migration path for databases created before an index was added
+        """
+        existing = {
+            index["name"] for index in inspect(db.engine).get_indexes(cls.__tablename__)
+        }
+        created = []
+        for index in cls.__table__.indexes:
+            if index.name not in existing:
+                logger.info("Creating index %s", index.name)
+                index.create(db.engine)
+                created.append(index.name)
+        return created
+
+    @classmethod
+    def all(cls, load=DEFAULT_LOAD_STRATEGY):
         """ Returns all of the records in the database """
         logger.info("Processing all records")
-        return cls.query.all()
+        return cls.with_loading(cls.query, load).all()
+
+    @classmethod
+    def paginate(cls, query, limit, after=None):
+        """ Returns a page of records ordered by id and the cursor of the next page
+        Args:
+            query (Query): the query to page through
+            limit (int): the maximum number of records on the page
+            after (int): only return records with an id greater than this cursor
+        """
+        logger.info("Processing page of %s after %s ...", limit, after)
+        return cls.split_page(cls.page_query(query, limit, after).all(), limit)
+
+    @classmethod
+    def page_query(cls, query, limit, after=None):
+        """ Restricts a query or select() to the page after a cursor
+        One extra record is fetched to know if there is a next page
+        """
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.order_by(cls.id).limit(limit + 1)
+
+    @staticmethod
+    def split_page(records, limit):
+        """ Returns the records of a page_query() and the cursor of the next page """
+        next_cursor = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_cursor = records[-1].id
+        return records, next_cursor
+
+    @classmethod
+    def iterate(cls, query, batch_size):
+        """ Iterates over the records of a query fetching them in batches
+        Args:
+            query (Query): the query to iterate over
+            batch_size (int): the number of rows fetched from the cursor at a time
+        """
+        logger.info("Processing records in batches of %s", batch_size)
+        return query.order_by(cls.id).yield_per(batch_size)
+
+    @classmethod
+    def allocate_ids(cls, count, session=None):
+        """
+        Returns count new ids from the id sequence of the table in one query
+        so that many records can be inserted with a single executemany, or
+        None when the database has no sequences
+        """
+        session = session or db.session
+        if not count or session.bind.dialect.name != "postgresql":
+            return None
+        rows = session.execute(
+            text(
+                "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                "FROM generate_series(1, :count)"
+            ),
+            {"table": '"{}"'.format(cls.__tablename__), "count": count},
+        )
+        return [order_id for order_id, in rows]
 
     @classmethod
     def find(cls, by_id):
@@ -70,6 +293,32 @@ class PersistentBase():
         logger.info("Processing lookup or 404 for id %s ...", by_id)
         return cls.query.get_or_404(by_id)
 
+    @classmethod
+    def find_version(cls, by_id):
+        """ Returns the version and update time of a record without loading it
+        It always comes from the database, the cache of a worker does not see
+        the changes made through the other workers
+        """
+        logger.info("Processing version lookup for id %s ...", by_id)
+        return db.session.query(cls.version, cls.updated).filter(cls.id == by_id).first()
+
+    @classmethod
+    def find_serialized_or_404(cls, by_id):
+        """ Returns a Serialized record from the cache, loading it on a miss
+        A cached record is only returned while the database has the same version
+        """
+        key = cls.cache_key(by_id)
+        serialized = cache.get(key)
+        if serialized is not None:
+            version = cls.find_version(by_id)
+            if version is not None and version[0] == serialized.version:
+                return serialized
+            cache.delete(key)  # changed or deleted through another worker
+        record = cls.find_or_404(by_id)
+        serialized = Serialized(record.serialize(), record.version, record.updated)
+        cache.set(key, serialized)
+        return serialized
+
 
 ######################################################################
 #  P R O D U C T   M O D E L
@@ -80,14 +329,35 @@ class Product(db.Model, PersistentBase):
     """
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
-    quantity = db.Column(db.Integer)
-    price = db.Column(db.Integer)
+    # active history keeps the old values that the Order totals are moved by
+    order_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True),
+        active_history=True
+    )
+    quantity = db.column_property(db.Column(db.Integer), active_history=True)
+    price = db.column_property(db.Column(db.Integer), active_history=True)
     name = db.Column(db.String(64))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __mapper_args__ = {"version_id_col": version}
     def __repr__(self):
         return "<Product %r id=[%s] order[%s]>" % (self.name, self.id, self.order_id)
     def __str__(self):
         return "%s: %s, %s" % (self.name, self.quantity, self.price)
+    def cache_keys(self):
+        """ Returns the keys of this Product and of the Order it is serialized in """
+        keys = super().cache_keys()
+        order_id = self.order_id if self.order_id is not None else getattr(self.order, "id", None)
+        if order_id is not None:
+            keys.append(Order.cache_key(order_id))
+        return keys
+    def delete(self, session=None):
+        """ Removes a Product from the data store and from its Order's products """
+        order = self.__dict__.get("order")
+        if order is not None and self in order.__dict__.get("products", ()):
+            order.products.remove(self)
+        super().delete(session)
+
     def serialize(self):
         """ Serializes a Product into a dictionary """
         return {
@@ -107,8 +377,9 @@ class Product(db.Model, PersistentBase):
         try:
             self.order_id = data["order_id"]
             self.name = data["name"]
-            self.quantity = data["quantity"]
-            self.price = data["price"]
+            # the Order totals are summed from these so they must be integers
+            self.quantity = to_integer(data["quantity"], "quantity")
+            self.price = to_integer(data["price"], "price")
         except KeyError as error:
             raise DataValidationError("Invalid Item: missing " + error.args[0])
         except TypeError as error:
@@ -116,6 +387,15 @@ class Product(db.Model, PersistentBase):
                 "Invalid Item: body of request contained" "bad or no data"
             )
         return self
+
+    @classmethod
+    def find_by_order(cls, order_id):
+        """ Returns all of the Products on an Order
+        Args:
+            order_id(int): the id of the Order the Products belong to
+        """
+        logger.info("Processing products query for order %s ...", order_id)
+        return cls.query.filter(cls.order_id == order_id)
 ######################################################################
 #  O R D E R   M O D E L
 ######################################################################
@@ -126,21 +406,45 @@ class Order(db.Model, PersistentBase):
     app = None
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(64))
-    status = db.Column(db.String(64))
+    name = db.Column(db.String(64), index=True)
+    status = db.Column(db.String(64), index=True)
+    # bumped on every change to the order or to any of its products
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     products = db.relationship('Product', backref='order', lazy=True)
+    # totals of the products, moved by touch_orders() whenever they change
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    total_price = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    __mapper_args__ = {"version_id_col": version}
+    # for listings filtered by status and paginated by id
+    __table_args__ = (db.Index("ix_order_status_id", "status", "id"),)
+    eager_relationships = ("products",)
+    # the fields that serialize() returns by default
+    FIELDS = ("id", "name", "status", "products")
+    # the fields that serialize() only returns when asked for
+    TOTALS = ("item_count", "total_price")
+    # the fields that are columns of the order table
+    COLUMN_FIELDS = ("id", "name", "status") + TOTALS
     def __repr__(self):
         return "<Order %r id=[%s]>" % (self.name, self.id)
-    def serialize(self):
-        """ Serializes a Account into a dictionary """
-        order = {
-            "id": self.id,
-            "name": self.name,
-            "status": self.status,
-            "products": []
-        }
-        for product in self.products:
-            order['products'].append(product.serialize())
+    def serialize(self, fields=None):
+        """
+        Serializes a Account into a dictionary
+        Args:
+            fields (set): the FIELDS and TOTALS to serialize, all of the
+                FIELDS when None
+        """
+        if fields is None:
+            fields = self.FIELDS
+        order = {}
+        for field in ("id", "name", "status"):
+            if field in fields:
+                order[field] = getattr(self, field)
+        if "products" in fields:
+            order["products"] = [product.serialize() for product in self.products]
+        for field in self.TOTALS:
+            if field in fields:
+                order[field] = getattr(self, field)
         return order
     def deserialize(self, data):
         """
@@ -165,11 +469,442 @@ class Order(db.Model, PersistentBase):
             )
         return self
 
+    def apply_product_changes(self, changes, session=None):
+        """
+        Adds, updates and removes Products on this Order in one transaction
+        Args:
+            changes (list): dictionaries with an "op" of add, update or remove,
+                the "id" of the Product to update or remove and the Product
+                data to add or update
+            session (Session): the session to change them in, db.session when None
+        """
+        session = session or db.session
+        if not isinstance(changes, list):
+            raise DataValidationError("Invalid Changes: body of request must be a list")
+        logger.info("Applying %s product changes to %s", len(changes), self.name)
+        products = {product.id: product for product in self.products}
+        try:
+            for change in changes:
+                if not isinstance(change, dict):
+                    raise DataValidationError("Invalid Change: must be an object")
+                operation = change.get("op")
+                if operation == "add":
+                    product = Product().deserialize(dict(change, order_id=self.id))
+                    self.products.append(product)
+                    continue
+                if operation not in ("update", "remove"):
+                    raise DataValidationError("Invalid Change: unknown op " + str(operation))
+                product = products.get(change.get("id"))
+                if product is None:
+                    raise DataValidationError(
+                        "Invalid Change: product {} is not on order {}".format(
+                            change.get("id"), self.id
+                        )
+                    )
+                if operation == "update":
+                    product.deserialize(dict(change, order_id=self.id))
+                else:
+                    self.products.remove(product)
+                    session.delete(product)
+                    del products[product.id]
+        except DataValidationError:
+            session.rollback()
+            raise
+        self.save(session)
+        return self
+
     @classmethod
-    def find_by_name(cls, name):
+    def check_fields(cls, fields):
+        """ Raises a DataValidationError if any of fields is not in FIELDS or TOTALS """
+        unknown = set(fields) - set(cls.FIELDS) - set(cls.TOTALS)
+        if unknown:
+            raise DataValidationError(
+                "Invalid fields: " + ", ".join(sorted(unknown))
+            )
+        return fields
+
+    @classmethod
+    def with_fields(cls, query, fields):
+        """ Only loads the columns of a query that are needed to serialize fields
+        Args:
+            query (Query): the query to restrict
+            fields (set): the FIELDS and TOTALS to serialize, all of the
+                FIELDS when None
+        """
+        if fields is None:
+            return query
+        columns = [getattr(cls, field) for field in cls.COLUMN_FIELDS if field in fields]
+        return query.options(load_only(*columns or [cls.id]))
+
+    @classmethod
+    def fields_query(cls, by_id, fields):
+        """ Returns a select() of the columns an Order is serialized from for
+        fields without the products, with its version and update time
+        """
+        columns = [getattr(cls, field) for field in cls.COLUMN_FIELDS if field in fields]
+        return select(*columns, cls.version, cls.updated).filter(cls.id == by_id)
+
+    @classmethod
+    def serialize_fields(cls, row, fields):
+        """ Returns a Serialized Order from a row of fields_query() """
+        data = {field: getattr(row, field) for field in cls.COLUMN_FIELDS if field in fields}
+        return Serialized(data, row.version, row.updated)
+
+    @classmethod
+    def find_fields(cls, by_id, fields):
+        """ Returns a Serialized Order with only fields, which must not have
+        the products, without loading the Order, or None if there is none
+        """
+        logger.info("Processing fields lookup for id %s ...", by_id)
+        row = db.session.execute(cls.fields_query(by_id, fields)).first()
+        return None if row is None else cls.serialize_fields(row, fields)
+
+    @classmethod
+    def totals_query(cls, by_id):
+        """ Returns a select() of the TOTALS of an Order """
+        return select(cls.item_count, cls.total_price).filter(cls.id == by_id)
+
+    @classmethod
+    def find_totals(cls, by_id):
+        """ Returns the TOTALS of an Order without loading it or None if there is none """
+        logger.info("Processing totals lookup for id %s ...", by_id)
+        row = db.session.execute(cls.totals_query(by_id)).first()
+        return None if row is None else dict(zip(cls.TOTALS, row))
+
+    @classmethod
+    def summary_query(cls, **filters):
+        """ Returns a select() of the number of Orders and their TOTALS by status
+        Args:
+            filters: the filters of search()
+        """
+        return (
+            select(
+                cls.status,
+                func.count(cls.id).label("orders"),
+                func.coalesce(func.sum(cls.item_count), 0).label("item_count"),
+                func.coalesce(func.sum(cls.total_price), 0).label("total_price"),
+            )
+            .filter(*cls.search_criteria(**filters))
+            .group_by(cls.status)
+            .order_by(cls.status)
+        )
+
+    @classmethod
+    def rebuild_totals(cls, chunk_size=10000):
+        """
+        Recomputes the TOTALS of every Order from its Products
+        The Orders are updated in chunks of ids, one transaction per chunk,
+        and only the Orders whose totals were wrong get a new version
+        Args:
+            chunk_size (int): the number of order ids updated per transaction
+        """
+        logger.info("Rebuilding order totals in chunks of %s", chunk_size)
+        item_count = (
+            select(func.coalesce(func.sum(Product.quantity), 0))
+            .where(Product.order_id == cls.id).scalar_subquery()
+        )
+        total_price = (
+            select(func.coalesce(func.sum(Product.quantity * Product.price), 0))
+            .where(Product.order_id == cls.id).scalar_subquery()
+        )
+        first, last = db.session.query(func.min(cls.id), func.max(cls.id)).one()
+        updated = 0
+        for start in range(first or 0, (last or -1) + 1, chunk_size):
+            result = db.session.execute(
+                cls.__table__.update()
+                .where(cls.id >= start, cls.id < start + chunk_size)
+                .where((cls.item_count != item_count) | (cls.total_price != total_price))
+                .values(
+                    item_count=item_count,
+                    total_price=total_price,
+                    version=cls.version + 1,
+                    updated=datetime.utcnow(),
+                )
+            )
+            db.session.commit()
+            updated += result.rowcount
+        if updated:
+            db.session.expire_all()
+            cache.clear()
+        return updated
+
+    @staticmethod
+    def serialize_summary(rows):
+        """ Serializes the rows of a summary_query() into a list of dictionaries """
+        return [
+            {
+                "status": row.status,
+                "orders": row.orders,
+                "item_count": int(row.item_count),
+                "total_price": int(row.total_price),
+            }
+            for row in rows
+        ]
+
+    @classmethod
+    def summary(cls, **filters):
+        """ Returns the number of Orders and their TOTALS for each status
+        Args:
+            filters: the filters of search()
+        """
+        logger.info("Processing summary for %s ...", filters)
+        return cls.serialize_summary(db.session.execute(cls.summary_query(**filters)))
+
+    @classmethod
+    def bulk_create(cls, orders, session=None, on_insert=None):
+        """ Inserts many Orders and their Products in a single transaction
+        The Orders are assigned their ids but are not added to the session
+        Args:
+            orders (list): deserialized Orders that have not been saved yet
+            session (Session): the session to insert them with, db.session when None
+            on_insert (function): called with the Orders once they have their ids,
+                the records it adds to the session are committed with them
+        """
+        logger.info("Bulk creating %s orders", len(orders))
+        session = session or db.session
+        try:
+            # collect the products first, the orders are detached once inserted
+            order_products = []
+            for order in orders:
+                order.id = None  # id must be none to generate next primary key
+                order_products.append(list(order.products))
+                # bulk saves skip the flush that keeps the totals
+                order.item_count = sum(line_totals(product)[0] for product in order.products)
+                order.total_price = sum(line_totals(product)[1] for product in order.products)
+            ids = cls.allocate_ids(len(orders), session)
+            if ids is None:
+                # one INSERT per order to read back its id
+                session.bulk_save_objects(orders, return_defaults=True)
+            else:
+                for order, order_id in zip(orders, ids):
+                    order.id = order_id
+                session.bulk_save_objects(orders)
+            products = []
+            for order, its_products in zip(orders, order_products):
+                for product in its_products:
+                    product.id = None
+                    product.order_id = order.id
+                    products.append(product)
+            session.bulk_save_objects(products)
+            if on_insert is not None:
+                on_insert(orders)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    @classmethod
+    def search(cls, load=DEFAULT_LOAD_STRATEGY, **filters):
+        """ Returns the Orders matching all of the given filters
+        Args:
+            load(string): the loading strategy for the products
+            name(string): the name on the Orders
+            status(string): the status of the Orders
+            product(string): the name of a Product on the Orders
+            min_id(int): the smallest id of the Orders
+            max_id(int): the largest id of the Orders
+        """
+        logger.info("Processing search for %s ...", filters)
+        return cls.with_loading(cls.query.filter(*cls.search_criteria(**filters)), load)
+
+    @classmethod
+    def search_criteria(cls, **filters):
+        """ Returns the SQL criteria of the search() filters for a query or select() """
+        criteria = []
+        if filters.get("name") is not None:
+            criteria.append(cls.name == filters["name"])
+        if filters.get("status") is not None:
+            criteria.append(cls.status == filters["status"])
+        if filters.get("product") is not None:
+            criteria.append(cls.products.any(Product.name == filters["product"]))
+        if filters.get("min_id") is not None:
+            criteria.append(cls.id >= filters["min_id"])
+        if filters.get("max_id") is not None:
+            criteria.append(cls.id <= filters["max_id"])
+        return criteria
+
+    @classmethod
+    def find_by_name(cls, name, load=DEFAULT_LOAD_STRATEGY):
         """ Returns all Orders with the given customer_id
         Args:
             name(string): the name on the Orders you want to match
+            load(string): the loading strategy for the products
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls.with_loading(cls.query.filter(cls.name == name), load)
+
+
+# Listens on every Session, the ASGI app flushes through its own sessions
+def line_totals(product, before=False):
+    """ Returns the item count and total price that a Product adds to its Order
+    Args:
+        product (Product): the Product
+        before (bool): use the values of the Product before its changes
+    """
+    values = []
+    for key in ("quantity", "price"):
+        history = attributes.get_history(product, key)
+        if before:
+            value = (history.deleted or history.unchanged or [None])[0]
+        else:
+            value = (history.added or history.unchanged or [None])[0]
+        values.append(value or 0)
+    quantity, price = values
+    return quantity, quantity * price
+
+
+def move_totals(session, order_id, item_count, total_price):
+    """ Adds to what the flush moves the totals of an Order by """
+    totals = session.info["order_totals"]
+    count, price = totals.get(order_id, (0, 0))
+    totals[order_id] = (count + item_count, price + total_price)
+
+
+@event.listens_for(Session, "before_flush")
+def touch_orders(session, flush_context, instances): # pylint: disable=unused-argument
+    """
+    Collects the Orders whose Products are changing, their totals take out
+    what the Products were and add what they are
+
+    A new Order gets its totals in its INSERT, the others are moved by
+    update_orders() once the Products are written
+    """
+    session.info["order_totals"] = {}
+    for record in session.new | session.dirty | session.deleted:
+        if not isinstance(record, Product):
+            continue
+        if record in session.dirty and not session.is_modified(record):
+            continue
+        if record not in session.new:
+            history = attributes.get_history(record, "order_id")
+            order_id = (history.deleted or history.unchanged or [None])[0]
+            if order_id is not None:
+                item_count, total_price = line_totals(record, before=True)
+                move_totals(session, order_id, -item_count, -total_price)
+        if record not in session.deleted:
+            # the Product is on the Order it was appended to or else its order_id
+            moved = attributes.get_history(
+                record, "order", attributes.PASSIVE_NO_INITIALIZE
+            ).added
+            order = moved[0] if moved else None
+            item_count, total_price = line_totals(record)
+            if order is not None and order in session.new:
+                order.item_count = (order.item_count or 0) + item_count
+                order.total_price = (order.total_price or 0) + total_price
+                continue
+            order_id = order.id if order is not None else record.order_id
+            if order_id is not None:
+                move_totals(session, order_id, item_count, total_price)
+
+
+@event.listens_for(Session, "after_flush_postexec")
+def update_orders(session, flush_context): # pylint: disable=unused-argument
+    """
+    Moves the version and totals of the Orders collected by touch_orders()
+    with one UPDATE each that adds to the values in the database. It is not
+    checked against the version that was loaded, so the writers of Products
+    on the same Order do not conflict with each other
+    """
+    totals = session.info.pop("order_totals", None)
+    if not totals:
+        return
+    table = Order.__table__
+    moved = ("version", "item_count", "total_price", "updated")
+    connection = session.connection()
+    # PostgreSQL gives the values back, SQLite has them read again
+    returning = connection.dialect.full_returning
+    now = datetime.utcnow()
+    for order_id, (item_count, total_price) in totals.items():
+        statement = table.update().where(table.c.id == order_id).values(
+            version=table.c.version + 1,
+            item_count=table.c.item_count + item_count,
+            total_price=table.c.total_price + total_price,
+            updated=now,
+        )
+        if returning:
+            statement = statement.returning(*(table.c[name] for name in moved))
+        result = connection.execute(statement)
+        row = result.first() if returning else None
+        order = session.identity_map.get(identity_key(Order, order_id))
+        if order is None:
+            continue
+        if row is None:
+            # read again when used
+            session.expire(order, list(moved))
+            continue
+        for name in moved:
+            attributes.set_committed_value(order, name, row[name])
+
+
+######################################################################
+#  I D E M P O T E N C Y   K E Y   M O D E L
+######################################################################
+class IdempotencyKey(db.Model):
+    """
+    The response of a create request sent with an Idempotency-Key header
+    The key is saved with its response in the transaction of the record it
+    creates, so there is never a record without its key and a retry never
+    creates it twice
+    """
+    __tablename__ = "idempotency_key"
+    # the method and path of the request with the key of the client
+    key = db.Column(db.String(255), primary_key=True)
+    # SHA-256 of the request body, a retry must send the same body
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer)
+    body = db.Column(db.LargeBinary)
+    headers = db.Column(db.JSON)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return "<IdempotencyKey %r status=[%s]>" % (self.key, self.status)
+
+    @classmethod
+    def find(cls, key, ttl, session=None):
+        """ Returns the key stored in the last ttl seconds or None
+        An expired key is deleted in the current transaction so it can be reused
+        """
+        logger.info("Processing idempotency key lookup for %s ...", key)
+        session = session or db.session
+        record = session.get(cls, key)
+        if record is not None and record.created < datetime.utcnow() - timedelta(seconds=ttl):
+            session.delete(record)
+            session.flush()
+            return None
+        return record
+
+    @classmethod
+    def purge_expired(cls, ttl):
+        """ Deletes the keys older than ttl seconds and returns how many there were """
+        logger.info("Purging idempotency keys older than %ss", ttl)
+        expired = datetime.utcnow() - timedelta(seconds=ttl)
+        count = cls.query.filter(cls.created < expired).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+######################################################################
+#  W R I T E   T I C K E T   M O D E L
+######################################################################
+class WriteTicket(db.Model):
+    """
+    The outcome of an Order accepted by the write-behind queue
+    It is committed in the transaction that inserts the Order, so an Order
+    that has a ticket is never inserted again when the queue is replayed
+    """
+    __tablename__ = "write_ticket"
+    id = db.Column(db.String(36), primary_key=True)
+    # None when the Order could not be saved
+    order_id = db.Column(db.Integer)
+    error = db.Column(db.String(255))
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return "<WriteTicket %r order_id=[%s]>" % (self.id, self.order_id)
+
+    @classmethod
+    def committed(cls, ticket_ids):
+        """ Returns the ids of the tickets that are already saved """
+        if not ticket_ids:
+            return set()
+        return {ticket_id for ticket_id, in db.session.query(cls.id).filter(cls.id.in_(ticket_ids))}
@@ -0,0 +1,132 @@
+"""
+Request parsing shared by the Flask and ASGI apps
+The functions take the query arguments and headers of a request as mappings,
+the request.args and request.headers of Flask or the query_params and headers
+of Starlette, and abort with the HTTPExceptions of werkzeug that both apps
+turn into the same JSON errors
+"""
+import json
+import logging
+from flask_api import status  # HTTP Status Codes
+from werkzeug.exceptions import abort
+from werkzeug.http import parse_date, parse_etags
+from service.models import Order
+
+logger = logging.getLogger("flask.app") # pylint: disable=locally-disabled, invalid-name
+
+
+def get_page_args(args, config):
+    """ Returns the limit and after cursor of a paginated listing request
+    Args:
+        args (dict): the query arguments of the request
+        config (dict): the app config with DEFAULT_PAGE_SIZE and MAX_PAGE_SIZE
+    """
+    try:
+        limit = int(args.get("limit", config["DEFAULT_PAGE_SIZE"]))
+        after = args.get("after")
+        if after is not None:
+            after = int(after)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "limit and after must be integers")
+    if limit < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "limit must be greater than 0")
+    return min(limit, config["MAX_PAGE_SIZE"]), after
+
+
+def get_order_filters(args):
+    """ Returns the Order search filters of a listing request """
+    filters = {}
+    for name in ("name", "status", "product"):
+        if args.get(name):
+            filters[name] = args[name]
+    for name in ("min_id", "max_id"):
+        if args.get(name):
+            try:
+                filters[name] = int(args[name])
+            except ValueError:
+                abort(status.HTTP_400_BAD_REQUEST, "{} must be an integer".format(name))
+    return filters
+
+
+def get_order_fields(args):
+    """ Returns the Order fields asked for by ?fields= and ?include= or None for all """
+    fields = args.get("fields")
+    include = args.get("include")
+    if not fields and not include:
+        return None
+    fields = set(fields.split(",")) if fields else set(Order.FIELDS)
+    if include:
+        fields.update(include.split(","))
+    if "totals" in fields:
+        fields.remove("totals")
+        fields.update(Order.TOTALS)
+    return Order.check_fields(fields)
+
+
+def is_conditional(headers):
+    """ Returns True if the request has conditional GET headers """
+    return (
+        bool(parse_etags(headers.get("If-None-Match")))
+        or parse_date(headers.get("If-Modified-Since")) is not None
+    )
+
+
+def is_not_modified(headers, version, updated):
+    """ Returns True if the client already has this version of a resource """
+    if_none_match = parse_etags(headers.get("If-None-Match"))
+    if if_none_match:
+        return if_none_match.contains(str(version))
+    if_modified_since = parse_date(headers.get("If-Modified-Since"))
+    if if_modified_since is not None and updated is not None:
+        return updated.replace(microsecond=0) <= if_modified_since
+    return False
+
+
+def check_if_match(headers, version):
+    """ Checks that the client is changing the current version of a resource """
+    if_match = parse_etags(headers.get("If-Match"))
+    if if_match and not if_match.contains(str(version)):
+        logger.warning("If-Match %s is not version %s", if_match, version)
+        abort(status.HTTP_412_PRECONDITION_FAILED, "The resource has been changed since it was read")
+
+
+def check_content_type(headers, *content_types):
+    """ Checks that the media type is correct """
+    content_type = headers.get("Content-Type")
+    if content_type in content_types:
+        return
+    logger.error("Invalid Content-Type: %s", content_type)
+    abort(
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        "Content-Type must be {}".format(" or ".join(content_types))
+    )
+
+
+def get_batch_items(headers, body):
+    """ Returns the items of a JSON array or newline delimited JSON request body
+    Args:
+        headers (dict): the headers of the request
+        body (str): the request body as text
+    """
+    if headers.get("Content-Type") == "application/x-ndjson":
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)  # reported as bad data by deserialize()
+        return items
+    try:
+        items = json.loads(body)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be JSON")
+    if not isinstance(items, list):
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be a JSON array of Orders")
+    return items
+
+
+def batch_error(index, code, error):
+    """ Makes the result of an item of a batch that could not be created """
+    return {"index": index, "status": code, "error": str(error)}
@@ -0,0 +1,143 @@
+"""
+Database connection pool configuration and instrumentation
+The pool options come from the DB_POOL_* settings in config.py and the
+pool records how long requests wait to check out a connection
+"""
+import time
+import logging
+import threading
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger("flask.app") # pylint: disable=locally-disabled, invalid-name
+
+# The drivers the asyncio engine of the ASGI app uses for each database
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+######################################################################
+#  P O O L   S T A T I S T I C S
+######################################################################
+class PoolStats():
+    """ Counts the connection checkouts of a pool and how long they waited """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait, timed_out=False):
+        """ Records one checkout that waited for wait seconds """
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += wait
+            self.wait_seconds_max = max(self.wait_seconds_max, wait)
+            if timed_out:
+                self.timeouts += 1
+
+    def serialize(self):
+        """ Serializes the statistics into a dictionary """
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+        }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool that records how long each checkout waits for a connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record(time.perf_counter() - start, timed_out=True)
+            logger.warning("Connection pool exhausted: %s", self.status())
+            raise
+        self.stats.record(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats  # keep counting across invalidations
+        return pool
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def database_uri(uri, asyncio=False):
+    """ Returns a database URI that SQLAlchemy can connect to
+    Args:
+        uri (string): the DATABASE_URI, postgres:// is accepted for postgresql://
+        asyncio (bool): switch the driver to the one in ASYNC_DRIVERS
+    """
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    if backend == "postgres":
+        backend = "postgresql"
+        url = url.set(drivername="postgresql")
+    if asyncio and backend in ASYNC_DRIVERS:
+        url = url.set(drivername=ASYNC_DRIVERS[backend])
+    return url.render_as_string(hide_password=False)
+
+
+def engine_options(config, asyncio=False):
+    """ Returns the SQLAlchemy engine options for the DB_POOL_* settings in config
+    Args:
+        config (dict): the app configuration
+        asyncio (bool): the options are for create_async_engine()
+    """
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    options = {"pool_pre_ping": config.get("DB_POOL_PRE_PING", True)}
+    if url.drivername.startswith("sqlite"):
+        # Flask-SQLAlchemy and aiosqlite pick a single connection pool for SQLite
+        return options
+    if not asyncio:
+        # the asyncio engine needs its own AsyncAdaptedQueuePool
+        options["poolclass"] = InstrumentedQueuePool
+    options.update(
+        pool_size=config.get("DB_POOL_SIZE", 5),
+        max_overflow=config.get("DB_MAX_OVERFLOW", 10),
+        pool_timeout=config.get("DB_POOL_TIMEOUT", 30),
+        pool_recycle=config.get("DB_POOL_RECYCLE", 1800),
+    )
+    statement_timeout = config.get("DB_STATEMENT_TIMEOUT", 0)
+    if statement_timeout and url.drivername.startswith("postgres"):
+        if asyncio:
+            options["connect_args"] = {
+                "server_settings": {"statement_timeout": str(statement_timeout)}
+            }
+        else:
+            options["connect_args"] = {
+                "options": "-c statement_timeout={}".format(statement_timeout)
+            }
+    return options
+
+
+def pool_status(pool):
+    """ Returns the sizes and checkout statistics of a connection pool """
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    stats = getattr(pool, "stats", None)
+    if stats is not None:
+        status.update(stats.serialize())
+    return status
@@ -0,0 +1,129 @@
+"""
+Read-only fast path for the GET routes
+The rows are selected as plain columns with SQLAlchemy Core and turned into
+the dictionaries of Order.serialize() and Product.serialize() without
+building ORM instances, then encoded with orjson when it is installed.
+It is used instead of the ORM when READ_PATH is core
+"""
+import json
+import logging
+from sqlalchemy import select
+from service.cache import cache
+from service.models import Order, Product, Serialized, db
+
+try:
+    import orjson
+except ImportError:
+    orjson = None # pylint: disable=invalid-name
+
+logger = logging.getLogger("flask.app.reads") # pylint: disable=locally-disabled, invalid-name
+
+# The columns serialized for each model, in the order of serialize()
+ORDER_COLUMNS = ("id", "name", "status")
+PRODUCT_COLUMNS = ("id", "order_id", "name", "quantity", "price")
+
+
+def dumps(data):
+    """ Encodes data as compact JSON bytes """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def product_columns():
+    """ Returns the Product columns that are serialized """
+    return [getattr(Product, name) for name in PRODUCT_COLUMNS]
+
+
+def products_by_order(order_ids):
+    """ Returns the serialized Products of the Orders grouped by order id
+    Args:
+        order_ids (list): the ids of the Orders, all fetched with one IN query
+    """
+    grouped = {order_id: [] for order_id in order_ids}
+    if not grouped:
+        return grouped
+    query = select(*product_columns()).filter(Product.order_id.in_(grouped)).order_by(Product.id)
+    for row in db.session.execute(query):
+        grouped[row.order_id].append(dict(zip(PRODUCT_COLUMNS, row)))
+    return grouped
+
+
+def search_orders(limit, after=None, fields=None, **filters):
+    """ Returns a page of serialized Orders and the cursor of the next page
+    Args:
+        limit (int): the maximum number of Orders on the page
+        after (int): only return Orders with an id greater than this cursor
+        fields (set): the FIELDS to serialize, all of them when None
+        filters: the filters of Order.search()
+    """
+    logger.info("Processing column search for %s ...", filters)
+    if fields is None:
+        fields = Order.FIELDS
+    names = [name for name in ORDER_COLUMNS + Order.TOTALS if name in fields]
+    # the id is always selected for the cursor and the products
+    columns = [Order.id] + [getattr(Order, name) for name in names if name != "id"]
+    query = select(*columns).filter(*Order.search_criteria(**filters))
+    rows, next_cursor = Order.split_page(
+        db.session.execute(Order.page_query(query, limit, after)).all(), limit
+    )
+    orders = [{name: getattr(row, name) for name in names} for row in rows]
+    if "products" in fields:
+        grouped = products_by_order([row.id for row in rows])
+        for order, row in zip(orders, rows):
+            order["products"] = grouped[row.id]
+    return orders, next_cursor
+
+
+def list_products(order_id, limit, after=None):
+    """ Returns a page of the serialized Products of an Order and the next cursor """
+    logger.info("Processing column products query for order %s ...", order_id)
+    query = select(*product_columns()).filter(Product.order_id == order_id)
+    rows, next_cursor = Product.split_page(
+        db.session.execute(Product.page_query(query, limit, after)).all(), limit
+    )
+    return [dict(zip(PRODUCT_COLUMNS, row)) for row in rows], next_cursor
+
+
+def load_order(order_id):
+    """ Returns a Serialized Order or None if there is no such Order """
+    columns = [getattr(Order, name) for name in ORDER_COLUMNS]
+    row = db.session.execute(
+        select(*columns, Order.version, Order.updated).filter(Order.id == order_id)
+    ).first()
+    if row is None:
+        return None
+    data = dict(zip(ORDER_COLUMNS, row))
+    data["products"] = products_by_order([order_id])[order_id]
+    return Serialized(data, row.version, row.updated)
+
+
+def load_product(product_id):
+    """ Returns a Serialized Product or None if there is no such Product """
+    row = db.session.execute(
+        select(*product_columns(), Product.version, Product.updated)
+        .filter(Product.id == product_id)
+    ).first()
+    if row is None:
+        return None
+    return Serialized(dict(zip(PRODUCT_COLUMNS, row)), row.version, row.updated)
+
+
+def find_serialized(model, by_id):
+    """ Returns a Serialized Order or Product from the cache, loading it on a miss
+    Args:
+        model (class): Order or Product
+        by_id (int): the id of the record
+    """
+    logger.info("Processing column lookup for id %s ...", by_id)
+    key = model.cache_key(by_id)
+    serialized = cache.get(key)
+    if serialized is not None:
+        version = model.find_version(by_id)
+        if version is not None and version[0] == serialized.version:
+            return serialized
+        cache.delete(key)  # changed or deleted through another worker
+    serialized = load_order(by_id) if model is Order else load_product(by_id)
+    if serialized is not None:
+        cache.set(key, serialized)
+    return serialized
@@ -6,14 +6,28 @@ Stores orders
 #import os
 #import sys
 #import logging
-from flask import  jsonify, request, url_for, make_response, abort #Flask,
+import click
+from flask import  jsonify, request, url_for, make_response, json #Flask,
+from flask import Response, stream_with_context
 from flask_api import status  # HTTP Status Codes
 from werkzeug.exceptions import NotFound
+from werkzeug.http import http_date
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 #from flask_sqlalchemy import SQLAlchemy
-from service.models import Order, Product, DataValidationError
+from service.models import Order, Product, IdempotencyKey, DataValidationError, db
+from service import reads
+from service.parsing import (
+    batch_error, check_content_type, check_if_match, get_batch_items, get_order_fields,
+    get_order_filters, get_page_args, is_conditional, is_not_modified
+)
+from service.pool import pool_status
+from service.metrics import metrics
+from service.idempotency import idempotent, store as idempotency_store
+from service.writebehind import PENDING, QueueFull, write_queue
 
 # Import Flask application
 from . import app
@@ -27,6 +41,33 @@ def request_validation_error(error):
     return bad_request(error)
 
 
+@app.errorhandler(QueueFull)
+def queue_full(error):
+    """ Handles a full write-behind queue with 503_SERVICE_UNAVAILABLE """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {"Retry-After": str(app.config["WRITE_RETRY_AFTER"])},
+    )
+
+
+@app.errorhandler(StaleDataError)
+def stale_data_error(error):
+    """ Handles a concurrent change to the version being updated
+    It is 412 for a client that sent If-Match, otherwise a 409 it can retry
+    """
+    db.session.rollback()
+    if "If-Match" in request.headers:
+        return precondition_failed(error)
+    return conflict(error)
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """ Handles bad reuests with 400_BAD_REQUEST """
@@ -63,6 +104,30 @@ def method_not_supported(error):
         status.HTTP_405_METHOD_NOT_ALLOWED,
     )
 
+@app.errorhandler(status.HTTP_409_CONFLICT)
+def conflict(error):
+    """ Handles a request that conflicts with another one with 409_CONFLICT """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+    )
+
+@app.errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """ Handles updates of a stale version with 412_PRECONDITION_FAILED """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
 @app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -106,6 +171,32 @@ def index():
         status.HTTP_200_OK,
     )
 
+######################################################################
+# CONNECTION POOL STATUS
+######################################################################
+@app.route("/pool", methods=["GET"])
+def get_pool():
+    """ Returns the size of the database connection pool and its checkout waits """
+    return make_response(jsonify(pool_status(db.engine.pool)), status.HTTP_200_OK)
+
+######################################################################
+# PROMETHEUS METRICS
+######################################################################
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """ Returns the request, SQL and connection pool metrics for Prometheus """
+    gauges = {}
+    for name in ("startup_seconds", "warm_up_seconds", "first_request_seconds"):
+        if getattr(metrics, name) is not None:
+            gauges["app_" + name] = round(getattr(metrics, name), 6)
+    for name, value in pool_status(db.engine.pool).items():
+        if isinstance(value, (int, float)):
+            gauges["db_pool_" + name] = value
+    return make_response(
+        metrics.render(gauges), status.HTTP_200_OK,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -120,17 +211,54 @@ def init_db():
 ######################################################################
 @app.route("/orders", methods=["GET"])
 def list_orders():
-    """ Returns all of the Orders """
+    """
+    Returns all of the Orders
+    The Orders can be filtered by ?name=, ?status=, ?product= (the name of a
+    product on the order), ?min_id= and ?max_id=
+    The fields of the Orders can be restricted with ?fields=id,status, with
+    the products only loaded when asked for by ?fields= or ?include=products
+    and the item_count and total_price by ?include=totals
+    The whole listing is streamed instead of paged when the client accepts
+    application/x-ndjson or asks for ?stream=true
+    """
     app.logger.info("Request for Order list")
-    orders = []
-    name = request.args.get("name")
-    if name:
-        orders = Order.find_by_name(name)
-    else:
-        orders = Order.all()
+    fields = get_order_fields(request.args)
+    filters = get_order_filters(request.args)
+    load = app.config["LOAD_STRATEGY"]
+    mimetype = get_stream_mimetype()
+    if not mimetype and is_core_read():
+        limit, after = get_page_args(request.args, app.config)
+        results, next_cursor = reads.search_orders(limit, after, fields, **filters)
+        return page_response(results, limit, next_cursor)
+    if fields is not None and "products" not in fields:
+        load = "select"  # the products are never touched so never loaded
+    elif mimetype and load == "joined":
+        # joined collection loading cannot be combined with batched fetching
+        load = "selectin"
+    query = Order.with_fields(Order.search(load, **filters), fields)
 
-    results = [order.serialize() for order in orders]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    if mimetype:
+        orders = Order.iterate(query, app.config["STREAM_BATCH_SIZE"])
+        return stream_response((order.serialize(fields) for order in orders), mimetype)
+
+    limit, after = get_page_args(request.args, app.config)
+    orders, next_cursor = Order.paginate(query, limit, after)
+
+    results = [order.serialize(fields) for order in orders]
+    return page_response(results, limit, next_cursor)
+
+######################################################################
+# SUMMARIZE ORDERS
+######################################################################
+@app.route("/orders/summary", methods=["GET"])
+def summarize_orders():
+    """
+    Returns the number of Orders and their item_count and total_price by status
+    The Orders can be filtered like the list of Orders
+    """
+    app.logger.info("Request for Order summary")
+    results = Order.summary(**get_order_filters(request.args))
+    return make_response(json_body(results), status.HTTP_200_OK)
 
 ######################################################################
 # RETRIEVE AN ORDER
@@ -140,24 +268,57 @@ def get_orders(order_id):
     """
     Retrieve a single Order
     This endpoint will return an Order based on it's id
+    It answers If-None-Match and If-Modified-Since with 304 Not Modified
+    without loading the Order when the client has the current version.
+    Fields without the products are selected alone, the products never loaded
     """
     app.logger.info("Request for Order with id: %s", order_id)
-    order = Order.find_or_404(order_id)
-    return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+    fields = get_order_fields(request.args)
+    if is_conditional(request.headers):
+        version = Order.find_version(order_id)
+        if version is not None and is_not_modified(request.headers, *version):
+            return not_modified_response(*version)
+    if fields is not None and "products" not in fields:
+        order = Order.find_fields(order_id, fields)
+        if order is None:
+            raise NotFound("Order with id '{}' was not found.".format(order_id))
+        data = order.data
+    else:
+        order = find_serialized_or_404(Order, order_id)
+        data = order.data
+        if fields is not None:
+            data = {field: data[field] for field in Order.FIELDS if field in fields}
+            if any(field in fields for field in Order.TOTALS):
+                totals = Order.find_totals(order_id) or {}
+                data.update((field, totals[field]) for field in Order.TOTALS if field in fields)
+    return make_response(
+        json_body(data), status.HTTP_200_OK, version_headers(order.version, order.updated)
+    )
 
 ######################################################################
 # CREATE A NEW ORDER
 ######################################################################
 @app.route("/orders", methods=["POST"])
+@idempotent
 def create_orders():
     """
     Creates an Order
     This endpoint will create an Order based the data in the body that is posted
+    A retry with the Idempotency-Key of an earlier request gets its response
+    With ORDER_WRITE_MODE queue the Order is saved later and the response is
+    202 with the Location of its ticket
     """
     app.logger.info("Request to create an Order")
-    check_content_type("application/json")
+    check_content_type(request.headers, "application/json")
     order = Order()
     order.deserialize(request.get_json())
+    if write_queue.enabled:
+        ticket = write_queue.submit(request.get_json())
+        location_url = url_for("get_order_tickets", ticket=ticket, _external=True)
+        return make_response(
+            jsonify(ticket=ticket, status="pending"), status.HTTP_202_ACCEPTED,
+            {"Location": location_url}
+        )
     order.create()
     message = order.serialize()
     location_url = url_for("get_orders", order_id=order.id, _external=True)
@@ -165,6 +326,85 @@ def create_orders():
         jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
     )
 
+######################################################################
+# GET THE STATUS OF A QUEUED ORDER
+######################################################################
+@app.route("/orders/tickets/<ticket>", methods=["GET"])
+def get_order_tickets(ticket):
+    """
+    Returns the status of an Order accepted by the write-behind queue
+    It is pending with 202 until the Order is saved, then created with the
+    id and Location of the Order or failed with the error, 404 when unknown
+    """
+    app.logger.info("Request for ticket %s", ticket)
+    record = write_queue.status(ticket)
+    if record is None:
+        raise NotFound("Ticket '{}' was not found.".format(ticket))
+    if record is PENDING:
+        location_url = url_for("get_order_tickets", ticket=ticket, _external=True)
+        return make_response(
+            jsonify(ticket=ticket, status="pending"), status.HTTP_202_ACCEPTED,
+            {"Location": location_url}
+        )
+    if record.order_id is None:
+        return make_response(
+            jsonify(ticket=ticket, status="failed", error=record.error), status.HTTP_200_OK
+        )
+    location_url = url_for("get_orders", order_id=record.order_id, _external=True)
+    return make_response(
+        jsonify(ticket=ticket, status="created", id=record.order_id), status.HTTP_200_OK,
+        {"Location": location_url}
+    )
+
+######################################################################
+# CREATE ORDERS IN BULK
+######################################################################
+@app.route("/orders:batch", methods=["POST"])
+def create_orders_batch():
+    """
+    Creates many Orders
+    This endpoint takes a JSON array or newline delimited JSON of Orders and
+    inserts them in chunks of BATCH_CHUNK_SIZE, one transaction per chunk.
+    It returns the id or the error of every Order in the order they were sent
+    """
+    app.logger.info("Request to create a batch of Orders")
+    check_content_type(request.headers, "application/json", "application/x-ndjson")
+    results = []
+    orders = []
+    for index, data in enumerate(get_batch_items(request.headers, request.get_data(as_text=True))):
+        try:
+            orders.append((index, Order().deserialize(data)))
+        except DataValidationError as error:
+            results.append(batch_error(index, status.HTTP_400_BAD_REQUEST, error))
+
+    chunk_size = app.config["BATCH_CHUNK_SIZE"]
+    for start in range(0, len(orders), chunk_size):
+        chunk = orders[start:start + chunk_size]
+        try:
+            Order.bulk_create([order for _, order in chunk])
+        except SQLAlchemyError as error:
+            app.logger.error("Could not create batch of Orders: %s", error)
+            results.extend(
+                batch_error(index, status.HTTP_500_INTERNAL_SERVER_ERROR, error)
+                for index, _ in chunk
+            )
+            continue
+        results.extend(
+            {
+                "index": index,
+                "status": status.HTTP_201_CREATED,
+                "id": order.id,
+                "location": url_for("get_orders", order_id=order.id, _external=True),
+            }
+            for index, order in chunk
+        )
+
+    results.sort(key=lambda result: result["index"])
+    created = all(result["status"] == status.HTTP_201_CREATED for result in results)
+    return make_response(
+        jsonify(results), status.HTTP_201_CREATED if created else status.HTTP_207_MULTI_STATUS
+    )
+
 ######################################################################
 # UPDATE AN EXISTING ORDER
 ######################################################################
@@ -173,16 +413,22 @@ def update_orders(order_id):
     """
     Update an Order
     This endpoint will update an Order based the body that is posted
+    An If-Match header makes the update fail with 412 Precondition Failed
+    unless the Order is still at that version
     """
     app.logger.info("Request to update order with id: %s", order_id)
-    check_content_type("application/json")
+    check_content_type(request.headers, "application/json")
     order = Order.find(order_id)
     if not order:
         raise NotFound("Order with id '{}' was not found.".format(order_id))
+    check_if_match(request.headers, order.version)
     order.deserialize(request.get_json())
     order.id = order_id
     order.save()
-    return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+    return make_response(
+        jsonify(order.serialize()), status.HTTP_200_OK,
+        version_headers(order.version, order.updated)
+    )
 
 ######################################################################
 # DELETE AN ORDER
@@ -207,23 +453,38 @@ def delete_orders(order_id):
 ######################################################################
 @app.route("/orders/<int:order_id>/products", methods=["GET"])
 def list_products(order_id):
-    """ Returns all of the Products for an Order """
+    """
+    Returns all of the Products for an Order
+    The Products are versioned by their Order, whose version moves whenever
+    one of its Products changes
+    """
     app.logger.info("Request for Order Products...")
-    order = Order.find_or_404(order_id)
-    results = [product.serialize() for product in order.products]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    limit, after = get_page_args(request.args, app.config)
+    version = Order.find_version(order_id)
+    if version is None:
+        raise NotFound("Order with id '{}' was not found.".format(order_id))
+    if is_not_modified(request.headers, *version):
+        return not_modified_response(*version)
+    if is_core_read():
+        results, next_cursor = reads.list_products(order_id, limit, after)
+        return page_response(results, limit, next_cursor, version_headers(*version))
+    products, next_cursor = Product.paginate(Product.find_by_order(order_id), limit, after)
+    results = [product.serialize() for product in products]
+    return page_response(results, limit, next_cursor, version_headers(*version))
 
 ######################################################################
 # ADD AN PRODUCT TO AN ORDER
 ######################################################################
 @app.route('/orders/<int:order_id>/products', methods=['POST'])
+@idempotent
 def create_products(order_id):
     """
     Create an Product on an Order
     This endpoint will add an product to an order
+    A retry with the Idempotency-Key of an earlier request gets its response
     """
     app.logger.info("Request to add an product to an order")
-    check_content_type("application/json")
+    check_content_type(request.headers, "application/json")
     order = Order.find_or_404(order_id)
     product = Product()
     product.deserialize(request.get_json())
@@ -232,6 +493,23 @@ def create_products(order_id):
     message = product.serialize()
     return make_response(jsonify(message), status.HTTP_201_CREATED)
 
+######################################################################
+# ADD, UPDATE AND REMOVE PRODUCTS ON AN ORDER IN BULK
+######################################################################
+@app.route("/orders/<int:order_id>/products", methods=["PATCH"])
+def patch_products(order_id):
+    """
+    Change many Products on an Order
+    This endpoint applies a list of add, update and remove operations to the
+    products of an order in a single transaction and returns the products
+    """
+    app.logger.info("Request to change products on order with id: %s", order_id)
+    check_content_type(request.headers, "application/json")
+    order = Order.find_or_404(order_id)
+    order.apply_product_changes(request.get_json())
+    results = [product.serialize() for product in order.products]
+    return make_response(jsonify(results), status.HTTP_200_OK)
+
 ######################################################################
 # RETRIEVE AN Product FROM ORDER
 ######################################################################
@@ -242,8 +520,15 @@ def get_products(order_id, product_id): # pylint: disable=unused-argument
     This endpoint returns just an product
     """
     app.logger.info("Request to get an product with id: %s", product_id)
-    product = Product.find_or_404(product_id)
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    if is_conditional(request.headers):
+        version = Product.find_version(product_id)
+        if version is not None and is_not_modified(request.headers, *version):
+            return not_modified_response(*version)
+    product = find_serialized_or_404(Product, product_id)
+    return make_response(
+        json_body(product.data), status.HTTP_200_OK,
+        version_headers(product.version, product.updated)
+    )
 
 ######################################################################
 # UPDATE AN Product
@@ -253,14 +538,20 @@ def update_products(order_id, product_id): # pylint: disable=unused-argument
     """
     Update an Product
     This endpoint will update an Product based the body that is posted
+    An If-Match header makes the update fail with 412 Precondition Failed
+    unless the Product is still at that version
     """
     app.logger.info("Request to update product with id: %s", product_id)
-    check_content_type("application/json")
+    check_content_type(request.headers, "application/json")
     product = Product.find_or_404(product_id)
+    check_if_match(request.headers, product.version)
     product.deserialize(request.get_json())
     product.id = product_id
     product.save()
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    return make_response(
+        jsonify(product.serialize()), status.HTTP_200_OK,
+        version_headers(product.version, product.updated)
+    )
 
 ######################################################################
 # DELETE AN PRODUCT
@@ -285,10 +576,98 @@ def init_db():
     """ Initialies the SQLAlchemy app """
     global app # pylint: disable=locally-disabled, invalid-name
     Order.init_db(app)
- 
-def check_content_type(content_type):
-    """ Checks that the media type is correct """
-    if request.headers["Content-Type"] == content_type:
-        return
-    app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
-    abort(415, "Content-Type must be {}".format(content_type))
+    idempotency_store.init_app(app)
+    write_queue.init_app(app)
+
+@app.cli.command("create-db")
+def create_db():
+    """ Creates the tables of the models that do not exist yet """
+    db.create_all()
+    print("Created the tables of {}".format(db.engine.url.render_as_string()))
+
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """ Adds the columns and indexes missing from an existing database """
+    for model in (Order, Product):
+        for name in model.add_missing_columns():
+            print("Added column {}.{}".format(model.__tablename__, name))
+        for name in model.create_indexes():
+            print("Created index {}".format(name))
+
+@app.cli.command("rebuild-totals")
+@click.option("--chunk-size", default=10000, help="Order ids updated per transaction")
+def rebuild_totals(chunk_size):
+    """ Recomputes the item_count and total_price of every Order """
+    print("Rebuilt the totals of {} orders".format(Order.rebuild_totals(chunk_size)))
+
+@app.cli.command("purge-idempotency-keys")
+def purge_idempotency_keys():
+    """ Deletes the Idempotency-Keys older than IDEMPOTENCY_TTL """
+    count = IdempotencyKey.purge_expired(app.config["IDEMPOTENCY_TTL"])
+    print("Purged {} idempotency keys".format(count))
+
+def page_response(results, limit, next_cursor, headers=None):
+    """ Makes a listing response with a Link to the next page if there is one """
+    headers = dict(headers or {})
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args.update(request.view_args)
+        args.update(limit=limit, after=next_cursor)
+        next_url = url_for(request.endpoint, _external=True, **args)
+        headers["Link"] = '<{}>; rel="next"'.format(next_url)
+        headers["X-Next-Cursor"] = str(next_cursor)
+    return make_response(json_body(results), status.HTTP_200_OK, headers)
+
+def is_core_read():
+    """ Returns True if the GET routes read through the Core fast path """
+    return app.config["READ_PATH"] == "core"
+
+def json_body(data):
+    """ Makes a JSON response body with the fast encoder on the core READ_PATH """
+    if is_core_read():
+        return Response(reads.dumps(data), mimetype="application/json")
+    return jsonify(data)
+
+def find_serialized_or_404(model, by_id):
+    """ Returns a Serialized Order or Product through the READ_PATH """
+    if not is_core_read():
+        return model.find_serialized_or_404(by_id)
+    serialized = reads.find_serialized(model, by_id)
+    if serialized is None:
+        raise NotFound("{} with id '{}' was not found.".format(model.__name__, by_id))
+    return serialized
+
+def get_stream_mimetype():
+    """ Returns the media type to stream a listing as or None to page it """
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    if best == "application/x-ndjson":
+        return best
+    if request.args.get("stream", "").lower() in ("true", "1"):
+        return "application/json"
+    return None
+
+def stream_response(results, mimetype):
+    """ Streams results as a chunked JSON array or as newline delimited JSON """
+    def generate():
+        if mimetype == "application/x-ndjson":
+            for result in results:
+                yield json.dumps(result) + "\n"
+            return
+        yield "["
+        separator = ""
+        for result in results:
+            yield separator + json.dumps(result)
+            separator = ","
+        yield "]"
+    return Response(stream_with_context(generate()), status.HTTP_200_OK, mimetype=mimetype)
+
+def version_headers(version, updated):
+    """ Returns the ETag and Last-Modified headers of a version of a resource """
+    headers = {"ETag": '"{}"'.format(version)}
+    if updated is not None:
+        headers["Last-Modified"] = http_date(updated)
+    return headers
+
+def not_modified_response(version, updated):
+    """ Makes a 304 Not Modified response for a version of a resource """
+    return make_response("", status.HTTP_304_NOT_MODIFIED, version_headers(version, updated))
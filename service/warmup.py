@@ -0,0 +1,80 @@
+"""
+Worker warm-up
+Runs the hot lookups of the routes once before a worker takes traffic so
+their SQL is compiled into the statement cache of the engine, and opens the
+connections of the pool, so the first requests do not pay for either.
+
+SQLAlchemy 1.4 caches every compiled statement by its structure, with the
+bound values left out, which is what the baked queries used to do by hand,
+so a lookup for id 0 warms the lookup of every id. The cache belongs to the
+engine, so every worker warms its own
+"""
+import time
+import logging
+from sqlalchemy.exc import SQLAlchemyError
+from service import reads
+from service.models import Order, Product, db
+
+logger = logging.getLogger("flask.app") # pylint: disable=locally-disabled, invalid-name
+
+# An id no record has, the lookups find nothing and change nothing
+MISSING_ID = 0
+
+
+def prime_pool(count):
+    """ Opens count connections at once and returns them to the pool
+    Returns:
+        the number of connections opened
+    """
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(db.engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def compile_lookups(config):
+    """ Runs the lookups of the routes with values that match nothing """
+    load = config["LOAD_STRATEGY"]
+    limit = config["DEFAULT_PAGE_SIZE"]
+    for model in (Order, Product):
+        model.find(MISSING_ID)
+        model.find_version(MISSING_ID)
+    Order.find_totals(MISSING_ID)
+    # the first page also compiles the loading of the products when there are orders
+    Order.paginate(Order.search(load), limit)
+    # find() leaves the products to be loaded on first access
+    db.session.expire_all()
+    for order in Order.paginate(Order.query, 1)[0]:
+        order.products # pylint: disable=pointless-statement
+    Order.find_by_name("", load).all()
+    Product.paginate(Product.find_by_order(MISSING_ID), limit)
+    if config["READ_PATH"] == "core":
+        reads.search_orders(limit)
+        reads.list_products(MISSING_ID, limit)
+        reads.load_order(MISSING_ID)
+        reads.load_product(MISSING_ID)
+
+
+def warm_up(app):
+    """ Primes the connection pool and compiles the hot lookups of app
+
+    A database that cannot be reached or has no tables yet only logs a
+    warning, the worker still starts and compiles on the first requests
+    Returns:
+        the seconds the warm-up took
+    """
+    started = time.perf_counter()
+    try:
+        connections = prime_pool(app.config["WARM_UP_CONNECTIONS"])
+        compile_lookups(app.config)
+    except SQLAlchemyError as error:
+        logger.warning("Warm-up failed, the first requests will be slower: %s", error)
+    else:
+        logger.info("Warmed up %s connections and the lookups", connections)
+    finally:
+        db.session.remove()
+    return time.perf_counter() - started
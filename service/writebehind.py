@@ -0,0 +1,374 @@
+"""
+Write-behind queue for creating Orders
+With ORDER_WRITE_MODE set to queue, POST /orders validates the Order,
+appends it to a journal file that is fsynced, and answers 202 with the URL
+of a ticket. A worker thread takes the journaled Orders in batches of up to
+WRITE_BATCH_SIZE and inserts each batch in one transaction, with the ticket
+of every Order, so many requests share one database commit.
+
+Every worker process has its own journal in WRITE_QUEUE_DIR, locked while
+the process runs. A process that starts takes over the journals that are no
+longer locked, so the Orders of a worker that died are still inserted, and
+the tickets already saved make sure none of them is inserted twice. When
+WRITE_QUEUE_MAX_SIZE Orders are waiting new ones are refused with 503
+"""
+import os
+import json
+import time
+import uuid
+import glob
+import fcntl
+import atexit
+import logging
+import itertools
+import threading
+from collections import deque
+from sqlalchemy.exc import OperationalError
+from service.models import Order, WriteTicket, db
+
+logger = logging.getLogger("flask.app") # pylint: disable=locally-disabled, invalid-name
+
+
+class QueueFull(Exception):
+    """ Raised when the write-behind queue cannot take more Orders """
+
+
+# status() of a ticket whose Order is journaled but not saved yet
+PENDING = "pending"
+
+
+######################################################################
+#  J O U R N A L
+######################################################################
+class Journal():
+    """
+    Append-only file of JSON entries
+    write() only hands an entry to the OS and sync() waits until it is on
+    disk, so the requests that write at the same time share one fsync
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = self.open_locked(path, "ab")
+        self.count = 0  # entries in the file
+        self.written = 0  # entries written since the journal was opened
+        self.synced = 0  # of those, how many are known to be on disk
+        self.sync_lock = threading.Lock()
+
+    @staticmethod
+    def open_locked(path, mode):
+        """ Opens a journal file with the lock that is held until it is closed """
+        journal = open(path, mode)
+        # no other process takes over a journal while its process runs
+        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return journal
+
+    @staticmethod
+    def encode(entry):
+        """ Returns an entry as a line of JSON """
+        return json.dumps(entry).encode("utf-8") + b"\n"
+
+    def write(self, entry):
+        """ Writes an entry without waiting for the disk
+        Returns:
+            the number of the entry to pass to sync()
+        """
+        self.file.write(self.encode(entry))
+        self.file.flush()
+        self.count += 1
+        self.written += 1
+        return self.written
+
+    def sync(self, number):
+        """ Waits until entry number is on disk, one fsync covers every entry written so far """
+        if self.synced >= number:
+            return
+        with self.sync_lock:
+            if self.synced >= number:
+                return  # the fsync of another request covered it
+            written = self.written
+            os.fsync(self.file.fileno())
+            self.synced = max(self.synced, written)
+
+    def append(self, entry):
+        """ Writes an entry and waits until it is on disk """
+        self.sync(self.write(entry))
+
+    def rewrite(self, entries):
+        """ Replaces the file by one with only the entries, the ones still waiting """
+        with self.sync_lock:
+            temporary = self.path + ".tmp"
+            journal = self.open_locked(temporary, "wb")
+            journal.write(b"".join(self.encode(entry) for entry in entries))
+            journal.flush()
+            os.fsync(journal.fileno())
+            os.rename(temporary, self.path)
+            directory = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            self.file.close()
+            self.file = journal
+            self.count = len(entries)
+            # the entries written to the old file are in the new one or saved
+            self.synced = self.written
+
+    def close(self):
+        """ Closes the file, releasing the lock """
+        self.file.close()
+
+    @staticmethod
+    def read(path):
+        """ Returns the entries of a journal, skipping a line cut short by a crash """
+        entries = []
+        with open(path, "rb") as journal:
+            for line in journal:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Skipping a partial entry of %s", path)
+        return entries
+
+    @staticmethod
+    def contains(path, ticket):
+        """ Returns True when a journal has an entry with the ticket """
+        needle = json.dumps({"ticket": ticket})[1:-1].encode("utf-8")
+        try:
+            with open(path, "rb") as journal:
+                return any(needle in line for line in journal)
+        except FileNotFoundError:
+            return False
+
+    @classmethod
+    def take_over(cls, path):
+        """ Returns the entries of a journal no process holds and removes it, or None """
+        with open(path, "ab") as journal:
+            try:
+                fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if os.fstat(journal.fileno()).st_ino != os.stat(path).st_ino:
+                    return None  # its process replaced it while this one waited
+            except OSError:
+                return None
+            entries = cls.read(path)
+            os.unlink(path)
+        return entries
+
+
+######################################################################
+#  W R I T E - B E H I N D   Q U E U E
+######################################################################
+class WriteBehindQueue():
+    """ The journaled Orders waiting to be inserted, configured from the Flask app """
+
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self.journal = None
+        self.directory = None
+        self.pending = deque()
+        self.tickets = set()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.max_size = 10000
+        self.batch_size = 500
+        self.batch_wait = 0.05
+
+    def init_app(self, app, start=True):
+        """
+        Opens the journal of this process and starts the worker thread
+        Args:
+            app (Flask): the app with the ORDER_WRITE_MODE and WRITE_* configuration
+            start (bool): start the thread, otherwise flush() inserts the Orders
+        """
+        self.enabled = app.config["ORDER_WRITE_MODE"] == "queue"
+        if not self.enabled:
+            return
+        self.app = app
+        self.max_size = app.config["WRITE_QUEUE_MAX_SIZE"]
+        self.batch_size = app.config["WRITE_BATCH_SIZE"]
+        self.batch_wait = app.config["WRITE_BATCH_WAIT_MS"] / 1000.0
+        self.directory = app.config["WRITE_QUEUE_DIR"]
+        os.makedirs(self.directory, exist_ok=True)
+        self.journal = Journal(
+            os.path.join(self.directory, "orders-{}.journal".format(os.getpid()))
+        )
+        for path in self.journals():
+            entries = Journal.take_over(path)
+            if entries:
+                logger.info("Taking over %s orders from %s", len(entries), path)
+                for entry in entries:
+                    self.journal.append(entry)
+                    self.pending.append(entry)
+                    self.tickets.add(entry["ticket"])
+        if start:
+            self.start()
+            atexit.register(self.stop)
+
+    def submit(self, data):
+        """ Journals the data of a validated Order and returns its ticket
+
+        Raises:
+            QueueFull: when WRITE_QUEUE_MAX_SIZE Orders are already waiting
+        """
+        entry = {"ticket": str(uuid.uuid4()), "data": data}
+        with self.condition:
+            if len(self.pending) >= self.max_size:
+                raise QueueFull("{} orders are waiting to be saved".format(len(self.pending)))
+            number = self.journal.write(entry)
+            self.pending.append(entry)
+            self.tickets.add(entry["ticket"])
+            self.condition.notify()
+        # outside of the lock so the requests waiting for the disk share an fsync
+        self.journal.sync(number)
+        return entry["ticket"]
+
+    def journals(self):
+        """ Returns the paths of the journals of the other processes """
+        return [path for path in glob.glob(os.path.join(self.directory, "*.journal"))
+                if path != self.journal.path]
+
+    def status(self, ticket, session=None):
+        """ Returns the WriteTicket of an Order, PENDING until it is saved
+
+        The Orders waiting in other worker processes are found in their
+        journals, a ticket that is in no journal and was never saved is unknown
+        Returns:
+            the WriteTicket, PENDING or None when the ticket is unknown
+        """
+        session = session or db.session
+        record = session.get(WriteTicket, ticket)
+        if record is not None:
+            return record
+        with self.condition:
+            if ticket in self.tickets:
+                return PENDING
+        if self.enabled and any(Journal.contains(path, ticket) for path in self.journals()):
+            return PENDING
+        # the Order may have been saved and dropped from its journal meanwhile
+        return session.get(WriteTicket, ticket, populate_existing=True)
+
+    def __len__(self):
+        return len(self.pending)
+
+######################################################################
+#  W O R K E R
+######################################################################
+
+    def start(self):
+        """ Starts the worker thread """
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Inserts the Orders still waiting and stops the worker thread """
+        if self.thread is None:
+            return
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+        self.thread = None
+
+    def close(self):
+        """ Stops the worker and closes the journal, which keeps what was not inserted """
+        self.stop()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.enabled = False
+
+    def run(self):
+        """ Inserts the waiting Orders a batch at a time until stopped """
+        with self.app.app_context():
+            while True:
+                entries = self.take()
+                if not entries:
+                    return
+                try:
+                    self.write(entries)
+                except OperationalError as error:
+                    # the database is unreachable, the batch is tried again
+                    logger.error("Could not save %s orders, retrying: %s", len(entries), error)
+                    time.sleep(1)
+                    continue
+                except Exception: # pylint: disable=broad-except
+                    # the thread must outlive any batch or the queue stops for good
+                    logger.exception("Dropping %s orders that could not be saved", len(entries))
+                finally:
+                    db.session.remove()
+                self.done(entries)
+
+    def take(self):
+        """ Waits for Orders and returns a batch of them, empty once stopped """
+        with self.condition:
+            while not self.pending and not self.stopping:
+                self.condition.wait()
+            # give the requests that are coming in a moment to join the batch
+            self.condition.wait_for(
+                lambda: self.stopping or len(self.pending) >= self.batch_size, self.batch_wait
+            )
+            return list(itertools.islice(self.pending, self.batch_size))
+
+    def done(self, entries):
+        """ Removes the inserted entries, compacting the journal once most of it is saved
+
+        The journal is rewritten with the waiting entries when it holds more
+        than twice as many, so it stays in proportion to the queue under load
+        """
+        with self.condition:
+            for entry in entries:
+                self.pending.popleft()
+                self.tickets.discard(entry["ticket"])
+            if self.journal.count > 2 * len(self.pending):
+                self.journal.rewrite(list(self.pending))
+
+    def flush(self):
+        """ Inserts every waiting Order from the calling thread """
+        while self.pending:
+            entries = list(itertools.islice(self.pending, self.batch_size))
+            self.write(entries)
+            self.done(entries)
+
+    def write(self, entries):
+        """ Inserts a batch, falling back to one Order at a time when the batch fails
+
+        An Order that cannot be inserted on its own gets a ticket with the error
+        """
+        try:
+            self.commit(entries)
+        except OperationalError:
+            raise
+        except Exception as error: # pylint: disable=broad-except
+            db.session.rollback()
+            if len(entries) > 1:
+                for entry in entries:
+                    self.write([entry])
+                return
+            message = "{}: {}".format(type(error).__name__, error)
+            logger.error("Could not save the order of ticket %s: %s", entries[0]["ticket"], message)
+            db.session.add(WriteTicket(id=entries[0]["ticket"], error=message[:255]))
+            db.session.commit()
+
+    @staticmethod
+    def commit(entries):
+        """ Inserts the Orders of the entries and their tickets in one transaction """
+        committed = WriteTicket.committed([entry["ticket"] for entry in entries])
+        entries = [entry for entry in entries if entry["ticket"] not in committed]
+        if not entries:
+            return
+        orders = [Order().deserialize(entry["data"]) for entry in entries]
+
+        def add_tickets(orders):
+            db.session.add_all(
+                WriteTicket(id=entry["ticket"], order_id=order.id)
+                for entry, order in zip(entries, orders)
+            )
+
+        logger.info("Saving %s queued orders", len(orders))
+        Order.bulk_create(orders, on_insert=add_tickets)
+
+
+write_queue = WriteBehindQueue() # pylint: disable=locally-disabled, invalid-name
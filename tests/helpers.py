@@ -0,0 +1,51 @@
+"""
+Test helpers for counting the SQL statements that code runs
+"""
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryCounter():
+    """ Context manager that records the SQL statements run inside it """
+
+    def __init__(self):
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        event.listen(Engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, *args): # pylint: disable=unused-argument
+        self.statements.append(statement)
+
+
+class QueryBudgetMixin():
+    """ Adds SQL statement budget assertions to a TestCase """
+
+    @contextmanager
+    def assertMaxQueries(self, budget, msg=None): # pylint: disable=invalid-name
+        """ Fails if the code inside runs more than budget SQL statements """
+        with QueryCounter() as counter:
+            yield counter
+        if len(counter) > budget:
+            statements = "\n".join(
+                "  {}. {}".format(n, " ".join(statement.split()))
+                for n, statement in enumerate(counter.statements, 1)
+            )
+            self.fail("{}: ran {} SQL statements, the budget is {}:\n{}".format(
+                msg or "Query budget exceeded", len(counter), budget, statements
+            ))
+
+    @contextmanager
+    def assertNumQueries(self, count, msg=None): # pylint: disable=invalid-name
+        """ Fails unless the code inside runs exactly count SQL statements """
+        with QueryCounter() as counter:
+            yield counter
+        self.assertEqual(len(counter), count, msg)
@@ -0,0 +1,74 @@
+"""
+Test cases for the read cache
+"""
+import time
+import unittest
+from service.cache import Cache, LRUCache, NullCache
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestCache(unittest.TestCase):
+    """ Test Cases for the cache backends """
+
+    def test_lru_get_and_set(self):
+        """ Store and fetch a value """
+        cache = LRUCache()
+        self.assertIsNone(cache.get("order:1"))
+        cache.set("order:1", {"id": 1})
+        self.assertEqual(cache.get("order:1"), {"id": 1})
+
+    def test_lru_evicts_least_recently_used(self):
+        """ Evict the least recently used value when full """
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_lru_expires(self):
+        """ Expire values after their time to live """
+        cache = LRUCache(ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_delete_and_clear(self):
+        """ Delete some values and then all of them """
+        cache = LRUCache()
+        for key in ("a", "b", "c"):
+            cache.set(key, key)
+        cache.delete("a", "b", "missing")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), "c")
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_null_cache(self):
+        """ Never store anything with caching turned off """
+        cache = NullCache()
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_init_app(self):
+        """ Configure the cache from the app config """
+        class App():
+            """ Stands in for the Flask app """
+            config = {"CACHE_TYPE": "lru", "CACHE_MAX_SIZE": 5, "CACHE_TTL": 10}
+        cache = Cache()
+        cache.init_app(App)
+        self.assertIsInstance(cache.backend, LRUCache)
+        self.assertEqual(cache.backend.max_size, 5)
+        App.config = {"CACHE_TYPE": "null"}
+        cache.init_app(App)
+        self.assertIsInstance(cache.backend, NullCache)
+        App.config = {"CACHE_TYPE": "memcached"}
+        self.assertRaises(ValueError, cache.init_app, App)
+        backend = LRUCache()
+        cache.init_app(App, backend)
+        self.assertIs(cache.backend, backend)
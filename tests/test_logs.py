@@ -0,0 +1,119 @@
+"""
+Test cases for the queued, sampled and JSON logging
+"""
+import io
+import json
+import queue
+import logging
+import unittest
+from flask import Flask
+from service import logs
+from service.logs import AsyncQueueHandler, BatchingListener, JsonFormatter, SamplingFilter
+
+
+def make_record(name="flask.app", level=logging.INFO, msg="Processing %s", args=(1,), **extra):
+    """ Returns a LogRecord with the extra attributes """
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class CountingStream(io.StringIO):
+    """ StringIO that counts its writes """
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+
+######################################################################
+#  L O G S   T E S T   C A S E S
+######################################################################
+class TestLogs(unittest.TestCase):
+    """ Test Cases for the logging setup """
+
+    def test_json_formatter(self):
+        """ Format a record and its extras as one JSON line """
+        line = JsonFormatter().format(make_record(request_id="abc"))
+        self.assertNotIn("\n", line)
+        data = json.loads(line)
+        self.assertEqual(data["message"], "Processing 1")
+        self.assertEqual(data["level"], "INFO")
+        self.assertEqual(data["logger"], "flask.app")
+        self.assertEqual(data["request_id"], "abc")
+        self.assertIn("time", data)
+
+    def test_sampling_filter(self):
+        """ Keep one in every 1 / rate INFO records of the sampled loggers """
+        sampling = SamplingFilter({"flask.app.models": 0.25, "flask.app.reads": 0})
+        kept = [sampling.filter(make_record("flask.app.models")) for _ in range(8)]
+        self.assertEqual(kept.count(True), 2)
+        self.assertFalse(sampling.filter(make_record("flask.app.reads")))
+        self.assertTrue(sampling.filter(make_record("flask.app.reads", logging.WARNING)))
+        self.assertTrue(sampling.filter(make_record("flask.app")))
+        self.assertEqual(sampling.sampled_logger("flask.app.models.child"), "flask.app.models")
+
+    def test_parse_sampling(self):
+        """ Parse logger=rate pairs """
+        self.assertEqual(logs.parse_sampling(""), {})
+        self.assertEqual(
+            logs.parse_sampling("flask.app.models=0.01, flask.app.reads=1"),
+            {"flask.app.models": 0.01, "flask.app.reads": 1.0}
+        )
+        self.assertRaises(ValueError, logs.parse_sampling, "flask.app.models=2")
+        self.assertRaises(ValueError, logs.parse_sampling, "flask.app.models")
+
+    def test_queue_handler(self):
+        """ Merge the arguments and drop the records when the queue is full """
+        handler = AsyncQueueHandler(queue.Queue(1))
+        handler.handle(make_record())
+        handler.handle(make_record())
+        self.assertEqual(handler.dropped, 1)
+        record = handler.queue.get_nowait()
+        self.assertEqual(record.msg, "Processing 1")
+        self.assertIsNone(record.args)
+
+    def test_batching_listener(self):
+        """ Write the queued records in order with one write per batch """
+        stream = CountingStream()
+        target = logging.StreamHandler(stream)
+        target.setFormatter(logging.Formatter("%(message)s"))
+        listener = BatchingListener(queue.Queue(), [target], batch_size=10)
+        for number in range(25):
+            listener.queue.put(make_record(args=(number,)))
+        listener.start()
+        listener.stop()
+        self.assertEqual(stream.getvalue().splitlines(),
+                         ["Processing {}".format(number) for number in range(25)])
+        self.assertEqual(stream.writes, 3)
+        self.assertIsNone(listener.thread)
+
+    def test_init_app_queue(self):
+        """ Send the app logger through the queue to its handlers """
+        app = Flask("test_logs")
+        app.config.update(LOG_MODE="queue", LOG_FORMAT="json", LOG_QUEUE_SIZE=100,
+                          LOG_BATCH_SIZE=10, LOG_SAMPLING="test_logs.models=0")
+        stream = io.StringIO()
+        app.logger.handlers = [logging.StreamHandler(stream)]
+        app.logger.setLevel(logging.INFO)
+        app.logger.propagate = False
+        listener = logs.init_app(app)
+        self.assertIsInstance(app.logger.handlers[0], AsyncQueueHandler)
+        app.logger.info("Creating %s", "order")
+        logging.getLogger("test_logs.models").info("Processing lookup")
+        listener.stop()
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([line["message"] for line in lines], ["Creating order"])
+
+    def test_init_app_sync(self):
+        """ Keep the handlers of the app logger in sync mode """
+        app = Flask("test_logs_sync")
+        app.config.update(LOG_MODE="sync", LOG_FORMAT="text", LOG_SAMPLING="")
+        handler = logging.StreamHandler(io.StringIO())
+        app.logger.handlers = [handler]
+        self.assertIsNone(logs.init_app(app))
+        self.assertEqual(app.logger.handlers, [handler])
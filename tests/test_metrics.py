@@ -0,0 +1,56 @@
+"""
+Test cases for the Prometheus metrics
+"""
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+# importing the app hooks the SQL timing into every Engine
+from service import app # pylint: disable=unused-import
+from service.metrics import Counter, Histogram, Metrics
+
+######################################################################
+#  M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for the metric types """
+
+    def test_counter(self):
+        """ Count by label values """
+        counter = Counter("requests_total", "Requests", ("method",))
+        counter.inc("GET")
+        counter.inc("GET")
+        counter.inc("POST", amount=3)
+        lines = counter.render()
+        self.assertIn("# TYPE requests_total counter", lines)
+        self.assertIn('requests_total{method="GET"} 2', lines)
+        self.assertIn('requests_total{method="POST"} 3', lines)
+
+    def test_histogram(self):
+        """ Count observations in cumulative buckets """
+        histogram = Histogram("latency_seconds", "Latency", ("endpoint",), (0.1, 1))
+        histogram.observe(0.05, "index")
+        histogram.observe(0.1, "index")
+        histogram.observe(0.5, "index")
+        histogram.observe(5, "index")
+        lines = histogram.render()
+        self.assertIn("# TYPE latency_seconds histogram", lines)
+        self.assertIn('latency_seconds_bucket{endpoint="index",le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{endpoint="index",le="1"} 3', lines)
+        self.assertIn('latency_seconds_bucket{endpoint="index",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_sum{endpoint="index"} 5.65', lines)
+        self.assertIn('latency_seconds_count{endpoint="index"} 4', lines)
+
+    def test_render_gauges(self):
+        """ Render the gauges sampled at scrape time """
+        text = Metrics().render({"db_pool_checked_out": 3})
+        self.assertIn("# TYPE db_pool_checked_out gauge\ndb_pool_checked_out 3\n", text)
+
+    def test_failed_statement(self):
+        """ Forget the start time of a SQL statement that failed """
+        engine = create_engine("sqlite://")
+        with engine.connect() as connection:
+            for _ in range(3):
+                self.assertRaises(OperationalError, connection.exec_driver_sql,
+                                  "SELECT * FROM missing")
+            connection.exec_driver_sql("SELECT 1")
+            self.assertEqual(connection.info["query_start"], {})
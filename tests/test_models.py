@@ -4,9 +4,13 @@ Test cases for Order Model
 import logging
 import unittest
 import os
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
 from service import app
 from service.models import Order, Product, DataValidationError, db
+from service.cache import cache
 from tests.factories import OrderFactory, ProductFactory
+from tests.helpers import QueryBudgetMixin
 
 # DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
 DATABASE_URI = os.getenv(
@@ -16,7 +20,7 @@ DATABASE_URI = os.getenv(
 ######################################################################
 #  Order   M O D E L   T E S T   C A S E S
 ######################################################################
-class TestOrder(unittest.TestCase):
+class TestOrder(QueryBudgetMixin, unittest.TestCase):
     """ Test Cases for Order Model """
 
     @classmethod
@@ -36,6 +40,7 @@ class TestOrder(unittest.TestCase):
     def setUp(self):
         """ This runs before each test """
         db.drop_all()  # clean up the last tests
+        cache.clear()
         db.create_all()  # make our sqlalchemy tables
 
     def tearDown(self):
@@ -162,6 +167,15 @@ class TestOrder(unittest.TestCase):
         self.assertEqual(products[0]['quantity'], product.quantity)
         self.assertEqual(products[0]['price'], product.price)
 
+    def test_serialize_order_fields(self):
+        """ Serialize some of the fields of an order """
+        order = self._create_order(products=[self._create_product()])
+        self.assertEqual(
+            order.serialize({"name", "status"}), {"name": order.name, "status": order.status}
+        )
+        self.assertEqual(len(order.serialize({"products"})["products"]), 1)
+        self.assertRaises(DataValidationError, Order.check_fields, {"id", "total"})
+
     def test_deserialize_an_order(self):
         """ Deserialize an order """
         product = self._create_product()
@@ -193,6 +207,15 @@ class TestOrder(unittest.TestCase):
         product = Product()
         self.assertRaises(DataValidationError, product.deserialize, [])
 
+    def test_deserialize_product_integers(self):
+        """ Deserialize the quantity and price of a product as integers """
+        data = {"order_id": 1, "name": "pen", "quantity": "2", "price": 3.0}
+        product = Product().deserialize(data)
+        self.assertEqual((product.quantity, product.price), (2, 3))
+        for value in ("two", 2.5, True, None, [1]):
+            self.assertRaises(DataValidationError, Product().deserialize, dict(data, quantity=value))
+            self.assertRaises(DataValidationError, Product().deserialize, dict(data, price=value))
+
     def test_add_order_product(self):
         """ Create an order with an product and add it to the database """
         orders = Order.all()
@@ -265,3 +288,265 @@ class TestOrder(unittest.TestCase):
         # Fetch it back again
         order = Order.find(order.id)
         self.assertEqual(len(order.products), 0)
+
+    def test_all_with_load_strategies(self):
+        """ List orders and their products with each loading strategy """
+        for _ in range(3):
+            order = self._create_order(
+                products=[self._create_product(), self._create_product()]
+            )
+            order.create()
+        db.session.expunge_all()
+        expected = {"select": 4, "selectin": 2, "joined": 1}
+        for load, count in expected.items():
+            db.session.expunge_all()
+            with self.assertNumQueries(count, load):
+                for order in Order.all(load):
+                    order.serialize()
+
+    def test_find_by_name_eager_loads(self):
+        """ Find by name loads the products up front """
+        order = self._create_order(products=[self._create_product()])
+        order.create()
+        name = order.name
+        db.session.expunge_all()
+        with self.assertNumQueries(1):
+            for same_order in Order.find_by_name(name, "joined"):
+                same_order.serialize()
+
+    def test_unknown_load_strategy(self):
+        """ Reject an unknown loading strategy """
+        self.assertRaises(ValueError, Order.all, "eager")
+
+    def test_paginate(self):
+        """ Page through orders keyed on id """
+        for _ in range(5):
+            self._create_order().create()
+        orders, cursor = Order.paginate(Order.query, 2)
+        self.assertEqual([order.id for order in orders], [1, 2])
+        self.assertEqual(cursor, 2)
+        orders, cursor = Order.paginate(Order.query, 2, after=cursor)
+        self.assertEqual([order.id for order in orders], [3, 4])
+        orders, cursor = Order.paginate(Order.query, 2, after=cursor)
+        self.assertEqual([order.id for order in orders], [5])
+        self.assertIsNone(cursor)
+
+    def test_bulk_create(self):
+        """ Create many orders with their products at once """
+        orders = [
+            self._create_order(products=[self._create_product()]) for _ in range(3)
+        ]
+        Order.bulk_create(orders)
+        self.assertEqual([order.id for order in orders], [1, 2, 3])
+        db.session.expunge_all()
+        orders = Order.all()
+        self.assertEqual(len(orders), 3)
+        for order in orders:
+            self.assertEqual(len(order.products), 1)
+            self.assertEqual(order.products[0].order_id, order.id)
+
+    def test_version_moves_with_products(self):
+        """ The version of an order moves when it or its products change """
+        order = self._create_order()
+        order.create()
+        self.assertEqual(order.version, 1)
+        self.assertIsNotNone(order.updated)
+        order.products.append(self._create_product())
+        order.save()
+        self.assertEqual(order.version, 2)
+        product = order.products[0]
+        product.price = 1000
+        product.save()
+        self.assertEqual(product.version, 2)
+        self.assertEqual(Order.find_version(order.id)[0], 3)
+        product.delete()
+        self.assertEqual(Order.find_version(order.id)[0], 4)
+        self.assertIsNone(Order.find_version(0))
+
+    def test_concurrent_update(self):
+        """ Refuse to save over a version changed by someone else """
+        order = self._create_order()
+        order.create()
+        order = Order.find(order.id)
+        self.assertEqual(order.version, 1)
+        order.name = "Happy-Happy Joy-Joy"
+        # another writer updates the order first
+        db.engine.execute('UPDATE "order" SET version = version + 1 WHERE id = 1')
+        self.assertRaises(StaleDataError, order.save)
+        db.session.rollback()
+
+    def test_concurrent_product_writes(self):
+        """ Add Products to the same Order from two sessions without a conflict """
+        order = self._create_order()
+        order.create()
+        first, second = Session(bind=db.engine), Session(bind=db.engine)
+        try:
+            orders = [session.get(Order, order.id) for session in (first, second)]
+            for session, loaded in zip((first, second), orders):
+                loaded.products.append(Product(name="item", quantity=2, price=5))
+                session.commit()
+        finally:
+            first.close()
+            second.close()
+        db.session.expire_all()
+        order = Order.find(order.id)
+        self.assertEqual(len(order.products), 2)
+        self.assertEqual(order.version, 3)
+        self.assertEqual((order.item_count, order.total_price), (4, 20))
+
+    def test_add_missing_columns(self):
+        """ Add the columns missing from an existing table """
+        db.drop_all()
+        db.engine.execute(
+            'CREATE TABLE "order" (id INTEGER PRIMARY KEY, name VARCHAR(64), status VARCHAR(64))'
+        )
+        db.engine.execute('INSERT INTO "order" (name, status) VALUES (\'old\', \'Delivered\')')
+        self.assertEqual(
+            Order.add_missing_columns(), ["version", "updated", "item_count", "total_price"]
+        )
+        self.assertEqual(Order.add_missing_columns(), [])
+        order = Order.find(1)
+        self.assertEqual(order.version, 1)
+        self.assertIsNone(order.updated)
+
+    def test_create_indexes(self):
+        """ Create the indexes missing from an existing database """
+        self.assertEqual(Order.create_indexes(), [])
+        self.assertEqual(Product.create_indexes(), [])
+        for index in Order.__table__.indexes:
+            if index.name == "ix_order_name":
+                index.drop(db.engine)
+        self.assertEqual(Order.create_indexes(), ["ix_order_name"])
+        self.assertEqual(Order.create_indexes(), [])
+
+    def test_search(self):
+        """ Search orders with several filters at once """
+        orders = [self._create_order() for _ in range(4)]
+        for order, status in zip(orders, ["Delivered", "Cancelled", "Delivered", "Delivered"]):
+            order.status = status
+        product = self._create_product()
+        orders[2].products.append(product)
+        for order in orders:
+            order.create()
+        found = Order.search(status="Delivered").all()
+        self.assertEqual([order.id for order in found], [1, 3, 4])
+        found = Order.search(status="Delivered", min_id=2, max_id=3).all()
+        self.assertEqual([order.id for order in found], [3])
+        found = Order.search(product=product.name, name=orders[2].name).all()
+        self.assertEqual([order.id for order in found], [3])
+        self.assertEqual(Order.search(status="Lost").all(), [])
+
+    def test_totals(self):
+        """ Sum the quantity and price of the products of an order in SQL """
+        order = self._create_order(products=[
+            Product(name="a", quantity=2, price=10), Product(name="b", quantity=3, price=5)
+        ])
+        order.create()
+        empty = self._create_order()
+        empty.create()
+        self.assertEqual(Order.find_totals(order.id), {"item_count": 5, "total_price": 35})
+        self.assertEqual(Order.find_totals(empty.id), {"item_count": 0, "total_price": 0})
+        self.assertIsNone(Order.find_totals(0))
+        db.session.expunge_all()
+        with self.assertNumQueries(1):
+            fields = {"id", "item_count", "total_price"}
+            orders = Order.with_fields(Order.query.order_by(Order.id), fields).all()
+            data = [order.serialize(fields) for order in orders]
+        self.assertEqual(data, [
+            {"id": order.id, "item_count": 5, "total_price": 35},
+            {"id": empty.id, "item_count": 0, "total_price": 0},
+        ])
+        self.assertNotIn("item_count", Order.find(order.id).serialize())
+
+    def test_summary(self):
+        """ Count the orders and sum their totals by status """
+        for status, quantity in [("Delivered", 1), ("Delivered", 2), ("Cancelled", 4)]:
+            order = self._create_order(products=[
+                Product(name="a", quantity=quantity, price=10),
+                Product(name="b", quantity=1, price=1),
+            ])
+            order.status = status
+            order.create()
+        order = self._create_order()
+        order.status = "Delivered"
+        order.create()
+        self.assertEqual(Order.summary(), [
+            {"status": "Cancelled", "orders": 1, "item_count": 5, "total_price": 41},
+            {"status": "Delivered", "orders": 3, "item_count": 5, "total_price": 32},
+        ])
+        self.assertEqual(Order.summary(max_id=1), [
+            {"status": "Delivered", "orders": 1, "item_count": 2, "total_price": 11},
+        ])
+        self.assertEqual(Order.summary(status="Lost"), [])
+
+    def test_totals_follow_products(self):
+        """ Keep the totals of orders current as their products change """
+        order = self._create_order(products=[
+            Product(name="a", quantity=2, price=10), Product(name="b", quantity=3, price=5)
+        ])
+        order.create()
+        other = self._create_order()
+        other.create()
+        def totals(order_id):
+            found = Order.find(order_id)
+            return found.item_count, found.total_price
+        self.assertEqual(totals(order.id), (5, 35))
+        first, second = order.products
+        first.quantity = 4
+        first.save()
+        self.assertEqual(totals(order.id), (7, 55))
+        second.delete()
+        self.assertEqual(totals(order.id), (4, 40))
+        order.apply_product_changes([
+            {"op": "add", "name": "c", "quantity": 1, "price": 7},
+            {"op": "update", "id": first.id, "name": "a", "quantity": 1, "price": 1},
+        ])
+        self.assertEqual(totals(order.id), (2, 8))
+        first.order_id = other.id
+        first.save()
+        self.assertEqual(totals(order.id), (1, 7))
+        self.assertEqual(totals(other.id), (1, 1))
+        product = Product(name="d", quantity=None, price=3, order_id=other.id)
+        product.create()
+        self.assertEqual(totals(other.id), (1, 1))
+        self.assertEqual(Order.find_totals(order.id), {"item_count": 1, "total_price": 7})
+
+    def test_bulk_create_totals(self):
+        """ Bulk created orders start with the totals of their products """
+        orders = [self._create_order(products=[
+            Product(name="a", quantity=2, price=10), Product(name="b", quantity=1, price=5)
+        ])]
+        Order.bulk_create(orders)
+        self.assertEqual(Order.find_totals(orders[0].id), {"item_count": 3, "total_price": 25})
+
+    def test_rebuild_totals(self):
+        """ Recompute the totals of orders whose totals are wrong """
+        for quantity in (1, 2, 3):
+            self._create_order(products=[Product(name="a", quantity=quantity, price=10)]).create()
+        self.assertEqual(Order.rebuild_totals(), 0)
+        db.engine.execute('UPDATE "order" SET item_count = 0, total_price = 0 WHERE id > 1')
+        cache.set(Order.cache_key(2), "stale")
+        self.assertEqual(Order.rebuild_totals(chunk_size=2), 2)
+        self.assertIsNone(cache.get(Order.cache_key(2)))
+        self.assertEqual(Order.find_totals(2), {"item_count": 2, "total_price": 20})
+        self.assertEqual(Order.find_totals(3), {"item_count": 3, "total_price": 30})
+        self.assertEqual(Order.find_version(1)[0], 1)
+        self.assertEqual(Order.find_version(2)[0], 2)
+
+    def test_write_without_reading_back(self):
+        """ Serialize what was written without reading it back """
+        order = self._create_order(products=[self._create_product()])
+        with self.assertNumQueries(2):
+            order.create()
+            data = order.serialize()
+        self.assertEqual(data["id"], order.id)
+        self.assertEqual(data["products"][0]["order_id"], order.id)
+        empty = self._create_order()
+        with self.assertNumQueries(1):
+            empty.create()
+            self.assertEqual(empty.serialize()["products"], [])
+        with self.assertNumQueries(1):
+            order.name = "renamed"
+            order.save()
+            self.assertEqual(order.serialize()["name"], "renamed")
+        self.assertEqual(order.version, 2)
@@ -0,0 +1,65 @@
+"""
+Test cases for the request parsing shared by the Flask and ASGI apps
+"""
+import unittest
+from datetime import datetime
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date
+from service import parsing
+
+CONFIG = {"DEFAULT_PAGE_SIZE": 20, "MAX_PAGE_SIZE": 100}
+
+######################################################################
+#  P A R S I N G   T E S T   C A S E S
+######################################################################
+class TestParsing(unittest.TestCase):
+    """ Test Cases for the request parsing """
+
+    def assertAborts(self, code, function, *args):
+        """ Asserts that a call aborts with an HTTP status code """
+        with self.assertRaises(HTTPException) as context:
+            function(*args)
+        self.assertEqual(context.exception.code, code)
+
+    def test_page_args(self):
+        """ Parse the limit and after cursor of a listing """
+        self.assertEqual(parsing.get_page_args({}, CONFIG), (20, None))
+        self.assertEqual(parsing.get_page_args({"limit": "500", "after": "7"}, CONFIG), (100, 7))
+        self.assertAborts(400, parsing.get_page_args, {"limit": "0"}, CONFIG)
+        self.assertAborts(400, parsing.get_page_args, {"after": "x"}, CONFIG)
+
+    def test_order_filters_and_fields(self):
+        """ Parse the filters and fields of an Order listing """
+        args = {"status": "open", "min_id": "3", "name": ""}
+        self.assertEqual(parsing.get_order_filters(args), {"status": "open", "min_id": 3})
+        self.assertAborts(400, parsing.get_order_filters, {"max_id": "x"})
+        self.assertIsNone(parsing.get_order_fields({}))
+        self.assertEqual(
+            parsing.get_order_fields({"fields": "id", "include": "totals"}),
+            {"id", "item_count", "total_price"}
+        )
+
+    def test_conditional_headers(self):
+        """ Compare the conditional headers with a version """
+        updated = datetime(2020, 1, 1, 12, 0, 0)
+        self.assertFalse(parsing.is_conditional(Headers()))
+        headers = Headers({"If-None-Match": '"3"'})
+        self.assertTrue(parsing.is_conditional(headers))
+        self.assertTrue(parsing.is_not_modified(headers, 3, updated))
+        self.assertFalse(parsing.is_not_modified(headers, 4, updated))
+        headers = Headers({"If-Modified-Since": http_date(updated)})
+        self.assertTrue(parsing.is_not_modified(headers, 4, updated))
+        parsing.check_if_match(Headers({"If-Match": '"3"'}), 3)
+        self.assertAborts(412, parsing.check_if_match, Headers({"If-Match": '"3"'}), 4)
+
+    def test_content_type_and_batch_items(self):
+        """ Check the media type and read the items of a batch """
+        headers = Headers({"Content-Type": "application/x-ndjson"})
+        parsing.check_content_type(headers, "application/json", "application/x-ndjson")
+        self.assertAborts(415, parsing.check_content_type, Headers(), "application/json")
+        self.assertEqual(parsing.get_batch_items(headers, '{"a": 1}\n\nbad\n'), [{"a": 1}, None])
+        headers = Headers({"Content-Type": "application/json"})
+        self.assertEqual(parsing.get_batch_items(headers, '[{"a": 1}]'), [{"a": 1}])
+        self.assertAborts(400, parsing.get_batch_items, headers, '{"a": 1}')
+        self.assertAborts(400, parsing.get_batch_items, headers, "not json")
@@ -5,13 +5,20 @@ Test cases can be run with the following:
     coverage report -m
 """
 import os
+import json
 import logging
 from unittest import TestCase
-#from unittest.mock import MagicMock #, patch
+from unittest.mock import patch
 from flask_api import status  # HTTP Status Codes
+from sqlalchemy import inspect
+from sqlalchemy.orm.exc import StaleDataError
 from tests.factories import OrderFactory, ProductFactory
-from service.models import db
+from tests.helpers import QueryBudgetMixin
+from service.models import Order, db
+from service.cache import cache
+from service.metrics import metrics
 from service.service import app, init_db
+from service import create_app
 
 # DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
 DATABASE_URI = os.getenv(
@@ -21,7 +28,7 @@ DATABASE_URI = os.getenv(
 ######################################################################
 #  T E S T   C A S E S
 ######################################################################
-class TestYourResourceServer(TestCase):
+class TestYourResourceServer(QueryBudgetMixin, TestCase):
     """ Orders Server Tests """
 
     @classmethod
@@ -41,6 +48,7 @@ class TestYourResourceServer(TestCase):
     def setUp(self):
         """ Runs before each test """
         db.drop_all()  # clean up the last tests
+        cache.clear()
         db.create_all()  # create new tables
         self.app = app.test_client()
 
@@ -77,6 +85,102 @@ class TestYourResourceServer(TestCase):
         resp = self.app.get("/")
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_get_pool(self):
+        """ Get the status of the connection pool """
+        resp = self.app.get("/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("pool", resp.get_json())
+
+    def test_create_app(self):
+        """ Set up the app once and report its startup time """
+        self.assertIs(create_app(), app)
+        app.logger.setLevel(logging.CRITICAL)
+        startup_seconds = metrics.startup_seconds
+        self.assertIsNotNone(startup_seconds)
+        self.assertIs(create_app(), app)
+        self.assertEqual(metrics.startup_seconds, startup_seconds)
+        resp = self.app.get("/metrics")
+        self.assertIn("app_startup_seconds", resp.get_data(as_text=True))
+        self.assertIn("app_first_request_seconds", resp.get_data(as_text=True))
+
+    def test_create_db(self):
+        """ Create the tables from the command line """
+        db.drop_all()
+        self.assertEqual(inspect(db.engine).get_table_names(), [])
+        result = app.test_cli_runner().invoke(args=["create-db"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(sorted(inspect(db.engine).get_table_names()), ["idempotency_key", "order", "product", "write_ticket"])
+
+    def test_get_metrics(self):
+        """ Get the request and SQL metrics """
+        self._create_orders(2)
+        self.app.get("/orders")
+        self.app.get("/no-such-path")
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/plain")
+        text = resp.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="POST",endpoint="create_orders",status="201"}', text)
+        self.assertIn('http_requests_total{method="GET",endpoint="unmatched",status="404"}', text)
+        self.assertIn('http_request_duration_seconds_count{method="GET",endpoint="list_orders"}', text)
+        self.assertIn('db_queries_per_request_bucket{endpoint="list_orders",le="+Inf"}', text)
+        self.assertIn('db_query_duration_seconds_per_request_sum{endpoint="list_orders"}', text)
+        self.assertIn('http_response_size_bytes_count{endpoint="list_orders"}', text)
+
+    def test_route_query_budgets(self):
+        """ Every route stays within its SQL statement budget """
+        product = dict(ProductFactory().serialize(), order_id=1)
+        order = dict(OrderFactory().serialize(), products=[product, product])
+        json_type = "application/json"
+        routes = [
+            ("create_orders", 3, lambda: self.app.post("/orders", json=order, content_type=json_type)),
+            # one INSERT per order for its id and one executemany for the products,
+            # PostgreSQL takes the ids from the sequence and inserts the orders at once
+            ("create_orders_batch", 11, lambda: self.app.post(
+                "/orders:batch", json=[order] * 10, content_type=json_type)),
+            ("list_orders", 2, lambda: self.app.get("/orders")),
+            ("summarize_orders", 1, lambda: self.app.get("/orders/summary")),
+            ("get_orders", 2, lambda: self.app.get("/orders/1")),
+            # SQLite has no RETURNING so the moved version is read back
+            ("update_orders", 6, lambda: self.app.put("/orders/1", json=order, content_type=json_type)),
+            ("list_products", 2, lambda: self.app.get("/orders/1/products")),
+            ("create_products", 4, lambda: self.app.post(
+                "/orders/1/products", json=product, content_type=json_type)),
+            ("patch_products", 5, lambda: self.app.patch("/orders/1/products", json=[
+                dict(product, op="add"), dict(product, op="update", id=1), {"op": "remove", "id": 2}
+            ], content_type=json_type)),
+            ("get_products", 1, lambda: self.app.get("/orders/1/products/1")),
+            ("update_products", 2, lambda: self.app.put(
+                "/orders/1/products/1", json=product, content_type=json_type)),
+            ("delete_products", 4, lambda: self.app.delete("/orders/1/products/1")),
+            ("create_orders", 1, lambda: self.app.post(
+                "/orders", json=OrderFactory().serialize(), content_type=json_type)),
+            ("delete_orders", 3, lambda: self.app.delete("/orders/12")),
+            ("index", 0, lambda: self.app.get("/")),
+            ("get_pool", 0, lambda: self.app.get("/pool")),
+            ("get_metrics", 0, lambda: self.app.get("/metrics")),
+        ]
+        for route, budget, call in routes:
+            db.session.remove()
+            cache.clear()
+            with self.assertMaxQueries(budget, route):
+                resp = call()
+            self.assertLess(resp.status_code, 400, route)
+
+    def test_query_budget_profiler(self):
+        """ Log the requests that go over the SQL statement budget """
+        self._create_orders(1)
+        metrics.profiling, metrics.query_budget = True, 1
+        try:
+            with self.assertLogs("flask.app", "WARNING") as logs:
+                self.app.get("/orders")
+                self.app.get("/")
+        finally:
+            metrics.profiling, metrics.query_budget = False, 10
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("GET /orders (list_orders) ran 2 SQL statements", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
     def test_get_order_list(self):
         """ Get a list of Orders """
         self._create_orders(5)
@@ -85,6 +189,113 @@ class TestYourResourceServer(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 5)
 
+    def test_get_order_list_query_count(self):
+        """ Listing Orders costs the same number of queries for any size """
+        orders = self._create_orders(5)
+        for order in orders:
+            for product in ProductFactory.create_batch(2):
+                resp = self.app.post(
+                    "/orders/{}/products".format(order.id), json=product.serialize(),
+                    content_type="application/json")
+                self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        db.session.remove()
+        with self.assertNumQueries(2):
+            resp = self.app.get("/orders")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 5)
+        self.assertEqual(sum(len(order["products"]) for order in data), 10)
+
+    def test_core_read_path(self):
+        """ The core READ_PATH returns the same JSON as the ORM """
+        orders = self._create_orders(3)
+        for order in orders:
+            resp = self.app.post(
+                "/orders/{}/products".format(order.id), json=ProductFactory().serialize(),
+                content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        product_id = resp.get_json()["id"]
+        urls = [
+            "/orders",
+            "/orders?limit=2&after={}".format(orders[0].id),
+            "/orders?fields=id,status&status={}".format(orders[0].status),
+            "/orders?fields=name&include=products",
+            "/orders?include=totals",
+            "/orders/{}?fields=id,total_price".format(orders[2].id),
+            "/orders/{}".format(orders[2].id),
+            "/orders/{}/products".format(orders[2].id),
+            "/orders/{}/products/{}".format(orders[2].id, product_id),
+            "/orders/0",
+        ]
+        responses = {}
+        for read_path in ("orm", "core"):
+            app.config["READ_PATH"] = read_path
+            cache.clear()
+            try:
+                responses[read_path] = [self.app.get(url) for url in urls]
+            finally:
+                app.config["READ_PATH"] = "orm"
+        for url, orm, core in zip(urls, responses["orm"], responses["core"]):
+            self.assertEqual(core.status_code, orm.status_code, url)
+            if orm.status_code == status.HTTP_200_OK:
+                self.assertEqual(core.get_json(), orm.get_json(), url)
+            self.assertEqual(core.headers.get("ETag"), orm.headers.get("ETag"), url)
+            self.assertEqual(core.headers.get("Link"), orm.headers.get("Link"), url)
+
+    def test_get_order_list_pages(self):
+        """ Page through the list of Orders with a cursor """
+        orders = self._create_orders(5)
+        resp = self.app.get("/orders?limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        ids = [order["id"] for order in resp.get_json()]
+        self.assertEqual(ids, [orders[0].id, orders[1].id])
+        self.assertEqual(resp.headers["X-Next-Cursor"], str(orders[1].id))
+        pages = 1
+        while "Link" in resp.headers:
+            next_url = resp.headers["Link"].split(";")[0].strip("<>")
+            resp = self.app.get(next_url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            ids += [order["id"] for order in resp.get_json()]
+            pages += 1
+        self.assertEqual(pages, 3)
+        self.assertEqual(ids, [order.id for order in orders])
+
+    def test_get_order_list_bad_page(self):
+        """ Reject a page request with a bad limit or cursor """
+        resp = self.app.get("/orders?limit=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/orders?limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/orders?after=xyz")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_order_list(self):
+        """ Stream the list of Orders as a JSON array """
+        self._create_orders(3)
+        resp = self.app.get("/orders?stream=true&limit=1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertTrue(resp.is_streamed)
+        data = resp.get_json()
+        self.assertEqual(len(data), 3)
+
+    def test_stream_empty_order_list(self):
+        """ Stream an empty list of Orders """
+        resp = self.app.get("/orders?stream=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+
+    def test_stream_order_list_ndjson(self):
+        """ Stream the list of Orders as newline delimited JSON """
+        orders = self._create_orders(3)
+        resp = self.app.get("/orders", headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        names = [json.loads(line)["name"] for line in lines]
+        self.assertEqual(names, [order.name for order in orders])
+
     def test_get_order_by_name(self):
         """ Get a Order by Name """
         orders = self._create_orders(3)
@@ -93,6 +304,130 @@ class TestYourResourceServer(TestCase):
         data = resp.get_json()
         self.assertEqual(data[0]["name"], orders[1].name)
 
+    def test_query_orders(self):
+        """ Query Orders by status, product and id range """
+        orders = self._create_orders(6)
+        product = ProductFactory()
+        resp = self.app.post(
+            "/orders/{}/products".format(orders[2].id), json=product.serialize(),
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        test_status = orders[0].status
+        resp = self.app.get("/orders?status={}".format(test_status))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        expected = [order.id for order in orders if order.status == test_status]
+        self.assertEqual([order["id"] for order in resp.get_json()], expected)
+
+        resp = self.app.get("/orders", query_string={"product": product.name})
+        self.assertEqual([order["id"] for order in resp.get_json()], [orders[2].id])
+
+        resp = self.app.get("/orders?min_id={}&max_id={}".format(orders[1].id, orders[3].id))
+        self.assertEqual(
+            [order["id"] for order in resp.get_json()], [order.id for order in orders[1:4]]
+        )
+
+        resp = self.app.get("/orders?min_id=one")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_list_fields(self):
+        """ Get a list of Orders with only some of their fields """
+        orders = self._create_orders(3)
+        resp = self.app.post(
+            "/orders/{}/products".format(orders[0].id), json=ProductFactory().serialize(),
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        db.session.remove()
+
+        with self.assertNumQueries(1):
+            resp = self.app.get("/orders?fields=id,status")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data[0], {"id": orders[0].id, "status": orders[0].status})
+
+        resp = self.app.get("/orders?fields=id&include=products")
+        data = resp.get_json()
+        self.assertEqual(set(data[0]), {"id", "products"})
+        self.assertEqual(len(data[0]["products"]), 1)
+
+        resp = self.app.get("/orders/{}?fields=name".format(orders[1].id))
+        self.assertEqual(resp.get_json(), {"name": orders[1].name})
+
+        # fields without the products select the order columns alone
+        cache.clear()
+        with self.assertNumQueries(1):
+            resp = self.app.get("/orders/{}?fields=id,status".format(orders[0].id))
+        self.assertEqual(resp.get_json(), {"id": orders[0].id, "status": orders[0].status})
+        self.assertIn("ETag", resp.headers)
+        resp = self.app.get("/orders/0?fields=id")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+        resp = self.app.get("/orders?fields=id,secret")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_totals(self):
+        """ Get Orders with the totals of their products """
+        orders = self._create_orders(2)
+        for quantity, price in [(2, 10), (1, 5)]:
+            product = dict(ProductFactory().serialize(), quantity=quantity, price=price)
+            resp = self.app.post(
+                "/orders/{}/products".format(orders[0].id), json=product,
+                content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        db.session.remove()
+        with self.assertNumQueries(2):
+            resp = self.app.get("/orders?include=totals")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data[0]["products"]), 2)
+        self.assertEqual((data[0]["item_count"], data[0]["total_price"]), (3, 25))
+        self.assertEqual((data[1]["item_count"], data[1]["total_price"]), (0, 0))
+        resp = self.app.get("/orders?fields=id,total_price")
+        self.assertEqual(resp.get_json()[0], {"id": orders[0].id, "total_price": 25})
+        resp = self.app.get("/orders/{}?fields=name,item_count".format(orders[0].id))
+        self.assertEqual(resp.get_json(), {"name": orders[0].name, "item_count": 3})
+        resp = self.app.get("/orders/{}".format(orders[0].id))
+        self.assertNotIn("total_price", resp.get_json())
+
+    def test_product_routes_move_totals(self):
+        """ Keep the stored totals current through the product routes """
+        order = self._create_orders(1)[0]
+        url = "/orders/{}/products".format(order.id)
+        def totals():
+            resp = self.app.get("/orders/{}?fields=item_count,total_price".format(order.id))
+            return resp.get_json()
+        product = dict(ProductFactory().serialize(), order_id=order.id, quantity=2, price=10)
+        resp = self.app.post(url, json=product, content_type="application/json")
+        product_url = "{}/{}".format(url, resp.get_json()["id"])
+        self.assertEqual(totals(), {"item_count": 2, "total_price": 20})
+        resp = self.app.put(
+            product_url, json=dict(product, quantity=3), content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(totals(), {"item_count": 3, "total_price": 30})
+        resp = self.app.delete(product_url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(totals(), {"item_count": 0, "total_price": 0})
+
+    def test_summarize_orders(self):
+        """ Summarize the Orders by status """
+        orders = self._create_orders(3)
+        product = dict(ProductFactory().serialize(), quantity=2, price=10)
+        resp = self.app.post(
+            "/orders/{}/products".format(orders[0].id), json=product,
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get("/orders/summary")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(sum(row["orders"] for row in data), 3)
+        self.assertEqual(sum(row["total_price"] for row in data), 20)
+        resp = self.app.get("/orders/summary?max_id={}".format(orders[0].id))
+        self.assertEqual(resp.get_json(), [{
+            "status": orders[0].status, "orders": 1, "item_count": 2, "total_price": 20
+        }])
+        resp = self.app.get("/orders/summary?min_id=one")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_order(self):
         """ Get a single Order """
         # get the id of an order
@@ -105,6 +440,101 @@ class TestYourResourceServer(TestCase):
         data = resp.get_json()
         self.assertEqual(data["name"], order.name)
 
+    def test_get_order_cached(self):
+        """ Get an Order from the cache until it is changed """
+        order = self._create_orders(1)[0]
+        resp = self.app.get("/orders/{}".format(order.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # only the version is read to check the cached order
+        with self.assertNumQueries(1):
+            self.app.get("/orders/{}".format(order.id))
+
+        # a change made through another worker, whose cache is not this one
+        key = Order.cache_key(order.id)
+        stale = cache.get(key)
+        data = dict(resp.get_json(), name="changed elsewhere")
+        self.app.put("/orders/{}".format(order.id), json=data, content_type="application/json")
+        cache.set(key, stale)
+        resp = self.app.get("/orders/{}".format(order.id))
+        self.assertEqual(resp.get_json()["name"], "changed elsewhere")
+        self.assertEqual(resp.headers["ETag"], '"{}"'.format(cache.get(key).version))
+
+        # adding a product evicts the order
+        resp = self.app.post(
+            "/orders/{}/products".format(order.id), json=ProductFactory().serialize(),
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        product = resp.get_json()
+        resp = self.app.get("/orders/{}".format(order.id))
+        self.assertEqual(resp.get_json()["products"], [product])
+
+        # updating the product evicts both the product and the order
+        resp = self.app.get("/orders/{}/products/{}".format(order.id, product["id"]))
+        self.assertEqual(resp.get_json()["name"], product["name"])
+        product["name"] = "XXXX"
+        resp = self.app.put(
+            "/orders/{}/products/{}".format(order.id, product["id"]), json=product,
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/orders/{}/products/{}".format(order.id, product["id"]))
+        self.assertEqual(resp.get_json()["name"], "XXXX")
+        resp = self.app.get("/orders/{}".format(order.id))
+        self.assertEqual(resp.get_json()["products"][0]["name"], "XXXX")
+
+        # deleting the order evicts it
+        self.app.delete("/orders/{}/products/{}".format(order.id, product["id"]))
+        resp = self.app.delete("/orders/{}".format(order.id))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get("/orders/{}".format(order.id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_order_not_modified(self):
+        """ Answer a conditional GET of an unchanged Order with 304 """
+        order = self._create_orders(1)[0]
+        resp = self.app.get("/orders/{}".format(order.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers["ETag"]
+        last_modified = resp.headers["Last-Modified"]
+
+        cache.clear()
+        with self.assertNumQueries(1):
+            resp = self.app.get("/orders/{}".format(order.id), headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.get_data(), b"")
+
+        resp = self.app.get(
+            "/orders/{}".format(order.id),
+            headers={"If-Modified-Since": last_modified})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # adding a product changes the version of the order and its products
+        resp = self.app.post(
+            "/orders/{}/products".format(order.id), json=ProductFactory().serialize(),
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        product = resp.get_json()
+        resp = self.app.get("/orders/{}".format(order.id), headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        etag = resp.headers["ETag"]
+
+        resp = self.app.get(
+            "/orders/{}/products".format(order.id), headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        resp = self.app.get("/orders/{}/products/{}".format(order.id, product["id"]))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(
+            "/orders/{}/products/{}".format(order.id, product["id"]),
+            headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        resp = self.app.get("/orders/0", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get("/orders/0/products")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_get_order_not_found(self):
         """ Get an Order that is not found """
         resp = self.app.get("/orders/0")
@@ -134,6 +564,72 @@ class TestYourResourceServer(TestCase):
         self.assertEqual(new_order["products"], order.products, "Product does not match") # pylint: disable=maybe-no-member
         self.assertEqual(new_order["status"], order.status, "Status does not match") # pylint: disable=maybe-no-member
 
+    def test_create_order_numeric_strings(self):
+        """ Create an Order whose Products have numbers sent as strings """
+        data = {"name": "strings", "status": "new", "products": [
+            {"order_id": None, "name": "pen", "quantity": "2", "price": "3"}
+        ]}
+        resp = self.app.post("/orders", json=data)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json()["products"][0]["quantity"], 2)
+        resp = self.app.get("/orders/{}?include=totals".format(resp.get_json()["id"]))
+        self.assertEqual(resp.get_json()["item_count"], 2)
+        self.assertEqual(resp.get_json()["total_price"], 6)
+        data["products"][0]["quantity"] = "two"
+        resp = self.app.post("/orders", json=data)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_orders_batch(self):
+        """ Create a batch of Orders in one request """
+        app.config["BATCH_CHUNK_SIZE"] = 2
+        try:
+            orders = [OrderFactory().serialize() for _ in range(4)]
+            orders[0]["products"] = [ProductFactory().serialize()]
+            orders[2] = {"name": "missing status"}
+            resp = self.app.post("/orders:batch", json=orders, content_type="application/json")
+        finally:
+            app.config["BATCH_CHUNK_SIZE"] = 1000
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = resp.get_json()
+        self.assertEqual([result["index"] for result in results], [0, 1, 2, 3])
+        self.assertEqual(
+            [result["status"] for result in results],
+            [status.HTTP_201_CREATED, status.HTTP_201_CREATED,
+             status.HTTP_400_BAD_REQUEST, status.HTTP_201_CREATED]
+        )
+        self.assertIn("error", results[2])
+
+        # Check that they were stored with their products
+        resp = self.app.get(results[0]["location"])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["name"], orders[0]["name"])
+        self.assertEqual(len(data["products"]), 1)
+        self.assertEqual(data["products"][0]["order_id"], results[0]["id"])
+        resp = self.app.get("/orders")
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_create_orders_batch_ndjson(self):
+        """ Create a batch of Orders from newline delimited JSON """
+        lines = [json.dumps(OrderFactory().serialize()) for _ in range(3)]
+        lines.insert(1, "not json")
+        resp = self.app.post(
+            "/orders:batch", data="\n".join(lines), content_type="application/x-ndjson"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = resp.get_json()
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[1]["status"], status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/orders")
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_create_orders_batch_not_a_list(self):
+        """ Reject a batch that is not a JSON array """
+        resp = self.app.post(
+            "/orders:batch", json=OrderFactory().serialize(), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_order(self):
         """ Update an existing Order """
         # create an Order to update
@@ -152,6 +648,57 @@ class TestYourResourceServer(TestCase):
         updated_order = resp.get_json()
         self.assertEqual(updated_order["name"], "Happy-Happy Joy-Joy")
 
+    def test_update_order_if_match(self):
+        """ Update an Order only if it has not changed since it was read """
+        order = self._create_orders(1)[0]
+        resp = self.app.get("/orders/{}".format(order.id))
+        etag = resp.headers["ETag"]
+        data = resp.get_json()
+
+        data["name"] = "first"
+        resp = self.app.put(
+            "/orders/{}".format(order.id), json=data, headers={"If-Match": etag},
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+        # a second writer that read the same version loses
+        data["name"] = "second"
+        resp = self.app.put(
+            "/orders/{}".format(order.id), json=data, headers={"If-Match": etag},
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.get("/orders/{}".format(order.id))
+        self.assertEqual(resp.get_json()["name"], "first")
+
+    def test_update_order_concurrently(self):
+        """ Answer a write that lost a race with 409 unless If-Match was sent """
+        order = self._create_orders(1)[0]
+        url = "/orders/{}".format(order.id)
+        data = self.app.get(url).get_json()
+        with patch("service.models.Order.save", side_effect=StaleDataError("changed")):
+            resp = self.app.put(url, json=data, content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+            resp = self.app.put(url, json=data, headers={"If-Match": '"1"'},
+                                content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_update_product_if_match(self):
+        """ Update a Product only if it has not changed since it was read """
+        order = self._create_orders(1)[0]
+        resp = self.app.post(
+            "/orders/{}/products".format(order.id), json=ProductFactory().serialize(),
+            content_type="application/json")
+        product = resp.get_json()
+        url = "/orders/{}/products/{}".format(order.id, product["id"])
+        resp = self.app.put(
+            url, json=product, headers={"If-Match": '"0"'}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        etag = self.app.get(url).headers["ETag"]
+        resp = self.app.put(
+            url, json=product, headers={"If-Match": etag}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
     def test_delete_order(self):
         """ Delete an Order """
         # get the id of an order
@@ -214,6 +761,15 @@ class TestYourResourceServer(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 2)
 
+        # page through them one at a time
+        resp = self.app.get("/orders/{}/products?limit=1".format(order.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1)
+        cursor = resp.headers["X-Next-Cursor"]
+        resp = self.app.get("/orders/{}/products?limit=1&after={}".format(order.id, cursor))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()[0]["id"], data[1]["id"])
+        self.assertNotIn("Link", resp.headers)
 
     def test_add_product(self):
         """ Add a product to an order """
@@ -229,6 +785,67 @@ class TestYourResourceServer(TestCase):
         self.assertEqual(data["quantity"], product.quantity)
         self.assertEqual(data["name"], product.name)
 
+    def test_patch_products(self):
+        """ Add, update and remove products on an order in one request """
+        order = self._create_orders(1)[0]
+        created = []
+        for product in ProductFactory.create_batch(2):
+            resp = self.app.post(
+                "/orders/{}/products".format(order.id), json=product.serialize(),
+                content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            created.append(resp.get_json())
+
+        new_product = ProductFactory().serialize()
+        new_product.pop("order_id")
+        changes = [
+            dict(new_product, op="add"),
+            dict(created[0], op="update", name="XXXX"),
+            {"op": "remove", "id": created[1]["id"]},
+        ]
+        resp = self.app.patch(
+            "/orders/{}/products".format(order.id), json=changes,
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0]["id"], created[0]["id"])
+        self.assertEqual(data[0]["name"], "XXXX")
+        self.assertEqual(data[1]["name"], new_product["name"])
+        self.assertEqual(data[1]["order_id"], order.id)
+
+        resp = self.app.get("/orders/{}/products/{}".format(order.id, created[1]["id"]))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_patch_products_is_atomic(self):
+        """ A bad change leaves the products of an order untouched """
+        order = self._create_orders(1)[0]
+        product = ProductFactory().serialize()
+        resp = self.app.post(
+            "/orders/{}/products".format(order.id), json=product,
+            content_type="application/json")
+        created = resp.get_json()
+        changes = [
+            dict(created, op="update", name="XXXX"),
+            {"op": "remove", "id": 0},
+        ]
+        resp = self.app.patch(
+            "/orders/{}/products".format(order.id), json=changes,
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/orders/{}/products".format(order.id))
+        self.assertEqual(resp.get_json()[0]["name"], product["name"])
+
+        resp = self.app.patch(
+            "/orders/{}/products".format(order.id), json={"op": "add"},
+            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for body in (5, True):
+            resp = self.app.patch(
+                "/orders/{}/products".format(order.id), json=body,
+                content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_product(self):
         """ Get an product from an order """
         # create a known product